@@ -35,37 +35,56 @@
 
 from __future__ import division, print_function
 import sys
+import os
 import os.path
 import re
-from time import sleep
-from optparse import OptionParser, OptionGroup
+from time import sleep, time
+from copy import copy
+from glob import glob
+from optparse import OptionParser, OptionGroup, SUPPRESS_HELP
+from threading import Lock, local
+try:
+	from threading import get_ident
+except ImportError:
+	from thread import get_ident # ver. < 3.0
+from io import BytesIO
+import select
+import signal
+from errno import EINTR, EAGAIN, EACCES
+try:
+	import fcntl
+except ImportError:
+	fcntl = None # Windows: no advisory locks
+from contextlib import contextmanager
+import struct
+import zlib
 from hashlib import sha256
 import json
-import platform
+from math import log
+from calendar import timegm
 
-# More python3-backward-incompatibility-breakage-related foo - thanks to Gord Palameta for the workaround:
 try:
-    # Python3
-    import http.cookiejar as cookiejar
-    from urllib.error import URLError, HTTPError
-    from urllib.parse import urlencode
-    from urllib.request import build_opener, install_opener, urlopen
-    from urllib.request import HTTPCookieProcessor
+    from configparser import ConfigParser, Error as ConfigParserError, NoOptionError
 except ImportError:
-    # Python2
-    import cookielib as cookiejar
-    from urllib2 import URLError, HTTPError
-    from urllib import urlencode
-    from urllib2 import build_opener, install_opener, urlopen
-    from urllib2 import HTTPCookieProcessor
+    from ConfigParser import ConfigParser, Error as ConfigParserError, NoOptionError  # ver. < 3.0
 
 try:
-    from configparser import ConfigParser, Error as ConfigParserError
+    from StringIO import StringIO  # ver. < 3.0, where pstats writes str
 except ImportError:
-    from ConfigParser import ConfigParser, Error as ConfigParserError  # ver. < 3.0
+    from io import StringIO
 
 from collections import namedtuple
 
+def add_secure_v5_args(args, guid):
+	"""Sign the arguments of a v5 request, primenet_v5_hashing is imported by the first request"""
+	global add_secure_v5_args
+	try:
+		from primenet_v5_hashing import add_secure_v5_args
+	except ImportError:
+		# primenet.py may be installed alone, the server then gets the placeholder signature
+		add_secure_v5_args = lambda args, guid: args + "&ss=19191919&sh=ABCDABCDABCDABCDABCDABCDABCDABCD"
+	return add_secure_v5_args(args, guid)
+
 if sys.version_info[:2] >= (3,7):
 	# If is OK to use dict in 3.7+ because insertion order is garantied to be preserved
 	# Since it is also faster, it is better to use raw dict()
@@ -124,10 +143,11 @@ class primenet_api:
 def debug_print(text, file=sys.stdout):
 	if options.debug or file == sys.stderr:
 		caller_name = sys._getframe(1).f_code.co_name
-		if caller_name == '<module>':
+		if caller_name in ('<module>', 'main'):
 			caller_name = 'main loop'
 		caller_string = caller_name + ": "
-		print(progname + ": " + caller_string + str(text), file=file)
+		# a single write, so that the lines printed by the requests in flight are not mixed
+		file.write(progname + ": " + workdir_tag + caller_string + str(text) + "\n")
 		file.flush()
 
 def greplike(pattern, l):
@@ -157,19 +177,141 @@ def readonly_list_file(filename, mode="r"):
 def read_list_file(filename, mode="r"):
 	return readonly_list_file(filename, mode=mode)
 
+def lock_file(File, blocking=True):
+	"""Take an advisory lock on an open file, released when the file is closed.
+	Return False if blocking is False and an other process holds the lock.
+	The locks only coordinate the primenet.py processes, Mlucas doesn't take them."""
+	if fcntl is None:
+		return True
+	try:
+		fcntl.flock(File.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except (IOError, OSError) as e:
+		if not blocking and e.errno in (EAGAIN, EACCES):
+			return False
+		raise
+	return True
+
+def replace(src, dst):
+	"""Rename src to dst, replacing dst if it exists, also on Windows where os.rename doesn't"""
+	if hasattr(os, "replace"): # Python 3.3+
+		os.replace(src, dst)
+		return
+	if os.name == "nt" and os.path.exists(dst):
+		# not atomic, there is no other way before Python 3.3
+		os.remove(dst)
+	os.rename(src, dst)
+
+@contextmanager
+def replace_file(filename, mode="w"):
+	"""Write the new content of filename to a temporary file, which replaces it
+	atomically when the block ends without error: Mlucas, the other processes and
+	a crash see either the old or the new content, never a partial file.
+	The permissions of the old file are kept (local.ini holds the password)."""
+	tmpfile = "{0}.{1}.{2}.tmp".format(filename, os.getpid(), get_ident())
+	try:
+		with open(tmpfile, mode) as File:
+			yield File
+			File.flush()
+			os.fsync(File.fileno())
+		if os.path.exists(filename):
+			os.chmod(tmpfile, os.stat(filename).st_mode & 0o7777)
+		replace(tmpfile, filename)
+	except BaseException:
+		if os.path.exists(tmpfile):
+			os.remove(tmpfile)
+		raise
+
 def write_list_file(filename, l, mode="w"):
-	# A "null append" is meaningful, as we can call this to clear the
-	# lockfile. In this case the main file need not be touched.
-	if not ( "a" in mode and len(l) == 0):
-		newline = b'\n' if 'b' in mode else '\n'
-		content = newline.join(l) + newline
-		File = open(filename, mode)
-		File.write(content)
-		File.close()
+	# Appended lines are written at once under an advisory lock, so that the lines
+	# of two writers are never mixed, other writes replace the file atomically.
+	# A "null append" doesn't touch the file.
+	if "a" in mode and len(l) == 0:
+		return
+	newline = b'\n' if 'b' in mode else '\n'
+	content = newline.join(l) + newline
+	if "a" in mode:
+		with open(filename, mode) as File:
+			lock_file(File)
+			File.write(content)
+	else:
+		with replace_file(filename, mode) as File:
+			File.write(content)
+
+def program_options(guid):
+	"""Send the work preference to the server if it has changed, return False on error
+	It is saved with the GUID it was sent for, so that it is sent again for a new GUID."""
+	work_preference = "{0},{1}".format(options.worktype, guid)
+	if state.has_option("primenet", "work_preference") and state.get("primenet", "work_preference") == work_preference:
+		return True
+	args = primenet_v5_bargs.copy()
+	args["t"] = "po"			# program options
+	args["c"] = 0				# the worker thread
+	args["w"] = options.worktype	# work preference
+	args["nw"] = 1				# number of workers
+	result = send_request(guid, args)
+	if result is None or int(result["pnErrorResult"]) != primenet_api.ERROR_OK:
+		debug_print("ERROR while setting the work preference on mersenne.org", file=sys.stderr)
+		if result is not None:
+			debug_print("Reason: "+result["pnErrorDetail"], file=sys.stderr)
+		return False
+	state.set("primenet", "work_preference", work_preference)
+	state.commit()
+	return True
+
+def get_assignment_v5(guid):
+	"""Get one assignment from the server, return its worktodo line or None"""
+	args = primenet_v5_bargs.copy()
+	args["t"] = "ga"			# get assignment
+	args["c"] = 0				# the worker thread
+	result = send_request(guid, args)
+	if result is None:
+		debug_print("ERROR while getting an assignment from mersenne.org", file=sys.stderr)
+		return None
+	rc = int(result["pnErrorResult"])
+	if rc != primenet_api.ERROR_OK:
+		if rc == primenet_api.ERROR_NO_ASSIGNMENT:
+			debug_print("No assignment available")
+		else:
+			debug_print("ERROR while getting an assignment from mersenne.org", file=sys.stderr)
+			debug_print("Reason: "+result["pnErrorDetail"], file=sys.stderr)
+		return None
+	# w= the work type, n= the exponent, sf= bits of trial factoring done, p1= P-1 done
+	try:
+		work_type = int(result["w"])
+		if work_type in (100, 102, 104):
+			return "Test={0},{1},{2},{3}".format(result["k"], result["n"], result["sf"], result["p1"])
+		elif work_type == 101:
+			return "DoubleCheck={0},{1},{2},{3}".format(result["k"], result["n"], result["sf"], result["p1"])
+		elif work_type in (150, 151, 152, 153):
+			# k*b^n+c, tests_saved, and for the double-checks the base and the residue type of the first test
+			task = "PRP={0},{1},{2},{3},{4},{5},{6}".format(result["k"], result["A"], result["b"], result["n"], result["c"], result["sf"], result["saved"])
+			if "base" in result:
+				task += ",{0},{1}".format(result["base"], result["rt"])
+			return task
+	except (KeyError, ValueError) as e:
+		debug_print("ERROR: incomplete assignment from mersenne.org, missing {0}".format(e), file=sys.stderr)
+		return None
+	# the assignment is already bound to this computer, it is given back so that it doesn't wait until it expires
+	debug_print("ERROR: unsupported work type {0} for assignment {1}, unreserving it".format(work_type, result["k"]), file=sys.stderr)
+	if not unreserve_assignment(guid, result["k"]):
+		debug_print("Unreserve assignment {0} on https://www.mersenne.org/workload/, or it stays assigned to this computer until it expires".format(result["k"]), file=sys.stderr)
+	return None
+
+def unreserve_assignment(guid, assignment_id):
+	"""Give an assignment back to the server, return False on error"""
+	args = primenet_v5_bargs.copy()
+	args["t"] = "au"			# assignment unreserve
+	args["k"] = assignment_id
+	result = send_request(guid, args)
+	if result is None or int(result["pnErrorResult"]) != primenet_api.ERROR_OK:
+		debug_print("ERROR while unreserving assignment {0} on mersenne.org".format(assignment_id), file=sys.stderr)
+		if result is not None:
+			debug_print("Reason: "+result["pnErrorDetail"], file=sys.stderr)
+		return False
+	debug_print("Assignment {0} unreserved".format(assignment_id))
+	return True
 
 def primenet_fetch(num_to_get):
-	if not primenet_login:
-		return []
 	# As of early 2018, here is the full list of assignment-type codes supported by the Primenet server; Mlucas
 	# v18 (and thus this script) supports only the subset of these indicated by an asterisk in the left column.
 	# Supported assignment types may be specified via either their PrimeNet number code or the listed Mnemonic:
@@ -215,6 +357,19 @@ def primenet_fetch(num_to_get):
 	if not options.worktype in supported:
 		debug_print("Unsupported/unrecognized worktype = " + options.worktype)
 		return []
+	guid = get_guid(config)
+	if guid is not None:
+		# registered: the assignments are given to this computer by the v5 API
+		if not program_options(guid):
+			return []
+		new_tasks = []
+		for i in range(num_to_get):
+			task = get_assignment_v5(guid)
+			if task is None:
+				break
+			new_tasks.append(task)
+		return new_tasks
+	# not registered: use the manual assignment page of the website
 	assignment = OrderedDict((
 		("cores","1"),
 		("num_to_get", num_to_get),
@@ -223,14 +378,14 @@ def primenet_fetch(num_to_get):
 		("exp_hi", ""),
 		("B1", "Get Assignments")
 	))
-	try:
-		openurl = primenet_baseurl + "manual_assignment/?" + urlencode(assignment)
-		debug_print("Fetching work via URL = "+openurl)
-		r = primenet.open(openurl)
-		return greplike(workpattern, [ line.decode('utf-8','replace') for line in r.readlines() ] )
-	except URLError:
+	open_network()
+	openurl = primenet_baseurl + "manual_assignment/?" + urlencode(assignment)
+	debug_print("Fetching work via URL = "+openurl)
+	res = primenet_open(openurl)
+	if res is None:
 		debug_print("URL open error at primenet_fetch")
 		return []
+	return greplike(workpattern, [ line.decode('utf-8','replace') for line in res.splitlines() ] )
 
 def get_assignment(progress):
 	w = read_list_file(workfile)
@@ -261,46 +416,199 @@ def get_assignment(progress):
 		for new_task in new_tasks:
 			debug_print("{0}".format(new_task))
 	write_list_file(workfile, new_tasks, "a")
+	metrics.set("primenet_queue_assignments", {"workdir": workdir}, len(tasks) + num_fetched)
 	if num_fetched < num_to_get:
 		debug_print("Error: Failed to obtain requested number of new assignments, " + str(num_to_get) + " requested, " + str(num_fetched) + " successfully retrieved")
 	return num_fetched
 
+# Pre-v19 old-style HRF-formatted result used "Program:..."; starting w/v19 JSON-formatted result uses "program",
+result_pattern = re.compile("[Pp]rogram")
 def mersenne_find(line, complete=True):
-	# Pre-v19 old-style HRF-formatted result used "Program:..."; starting w/v19 JSON-formatted result uses "program",
-	return re.search("[Pp]rogram", line)
+	return result_pattern.search(line)
+
+# as statistics.median_low, which takes longer to import than to compute the median of 5 values
+def median_low(mylist):
+    sorts = sorted(mylist)
+    length = len(sorts)
+    return sorts[(length-1)//2]
+
+def stat_filename(p, dirname=None):
+	return os.path.join(workdir if dirname is None else dirname, 'p' + str(p) + '.stat')
+
+def readonly_reversed_lines(filename, offset=0, block_size=64*1024):
+	"""Generate the complete lines of filename located after the byte offset, from
+	the last one to the first one, as (end, line) with end the offset after the line.
+	The file is read backward by blocks, so only its tail is read if the caller
+	stops early. An incomplete last line (being written) is skipped."""
+	try:
+		File = open(filename, "rb")
+	except (IOError,OSError):
+		return
+	with File:
+		File.seek(0, os.SEEK_END)
+		pos = end = File.tell()
+		rest = None # beginning of the line overlapping the previous block
+		while pos > offset:
+			size = min(block_size, pos - offset)
+			pos -= size
+			File.seek(pos)
+			block = File.read(size)
+			if rest is None:
+				# skip the incomplete last line
+				i = block.rfind(b"\n")
+				if i < 0:
+					end = pos
+					continue
+				end = pos + i + 1
+				block, rest = block[:i], b""
+			lines = (block + rest).split(b"\n")
+			if pos > offset:
+				rest = lines.pop(0)
+			for line in reversed(lines):
+				yield end, line.decode("utf-8", "replace").rstrip()
+				end -= len(line) + 1
+
+stat_regex = re.compile(r"Iter# = (.+?) .*?(\d+\.\d+) (m?sec)/iter")
+# date at the beginning of the Iter lines
+stat_date_regex = re.compile(r"^\[(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)\]")
+# written by Mlucas at each (re)start, the length is in K of 8-byte floats
+fft_regex = re.compile(r"using FFT length (\d+)K")
+fft_bytes_regex = re.compile(br"using FFT length (\d+)K")
+# per p*.stat file: (inode, offset after the last scanned line, the last Iter lines found, most recent first,
+# as (iteration, usec_per_iter, date in seconds or None), FFT length)
+stat_cache = {}
+
+def read_fft_length(statfile, offset, end, block_size=1024*1024):
+	"""Return the FFT length of the last (re)start written between the byte offsets offset and end, None
+	if there is none. The restart can be far from the end, the blocks are searched without splitting the lines."""
+	try:
+		File = open(statfile, "rb")
+	except (IOError,OSError):
+		return None
+	with File:
+		pos, overlap = end, b""
+		while pos > offset:
+			size = min(block_size, pos - offset)
+			pos -= size
+			File.seek(pos)
+			# with the beginning of the next block, for a line split between them
+			block = File.read(size) + overlap
+			fft_length = None
+			for res in fft_bytes_regex.finditer(block):
+				fft_length = int(res.group(1))
+			if fft_length is not None:
+				return fft_length
+			overlap = block[:64]
+	return None
+
+def stat_dates(statfile):
+	"""(date in seconds, iteration) of the last Iter lines found by parse_stat_file(), most recent first"""
+	cached = stat_cache.get(statfile)
+	if cached is None:
+		return []
+	return [(date, iteration) for iteration, _, date in cached[2] if date is not None]
 
-try:
-    from statistics import median_low
-except ImportError:
-    def median_low(mylist):
-        sorts = sorted(mylist)
-        length = len(sorts)
-        return sorts[(length-1)//2]
-
-def parse_stat_file(p):
-	statfile = 'p' + str(p) + '.stat'
-	w = readonly_list_file(statfile) # appended line by line, no lock needed
-	found = 0
-	regex = re.compile("Iter# = (.+?) .*?(\d+\.\d+) (m?sec)/iter")
-	list_usec_per_iter = []
-	# get the 5 most recent Iter line
-	for line in reversed(w):
-		res = regex.search(line)
-		if res:
-			found += 1
-			# keep the last iteration to compute the percent of progress
-			if found == 1:
+def stat_fft_length(statfile):
+	"""FFT length found by the last parse_stat_file() of statfile, None if unknown"""
+	cached = stat_cache.get(statfile)
+	return cached[3] if cached is not None else None
+
+def stat_scan_key(statfile):
+	"""The exponent of p<exponent>.stat"""
+	return os.path.basename(statfile)[1:-len(".stat")]
+
+def load_stat_scan(store, statfile, inode):
+	"""Return the scan of statfile saved in the state by a previous run, as in stat_cache, None if there
+	is none or if the file isn't the same: it is checked with the fingerprint of the bytes before the offset"""
+	try:
+		fields = store.get("stat_scan", stat_scan_key(statfile)).split(",")
+		offset = int(fields[0])
+		found = []
+		for field in fields[3:]:
+			iteration, usec_per_iter, date = field.split(" ")
+			found.append((int(iteration), float(usec_per_iter), int(date) if date != "-" else None))
+		with open(statfile, "rb") as File:
+			if os.fstat(File.fileno()).st_size < offset or file_fingerprint(File, offset) != fields[1]:
+				return None
+	except (ConfigParserError, ValueError, IOError, OSError):
+		return None
+	return (inode, offset, found, int(fields[2]) if fields[2] else None)
+
+def save_stat_scan(store, statfile, cached):
+	"""Save the scan of statfile in the state, so that the next runs only scan the bytes appended since"""
+	_, offset, found, fft_length = cached
+	with open(statfile, "rb") as File:
+		fingerprint = file_fingerprint(File, offset)
+	value = ",".join(["{0},{1},{2}".format(offset, fingerprint, fft_length or "")] +
+		["{0} {1!r} {2}".format(iteration, usec_per_iter, date if date is not None else "-") for iteration, usec_per_iter, date in found])
+	if not store.has_section("stat_scan"):
+		store.add_section("stat_scan")
+	store.set("stat_scan", stat_scan_key(statfile), value)
+
+def parse_stat_file(statfile, store=None):
+	# appended line by line, no lock needed
+	# The file is scanned from the end, and only the bytes appended since the
+	# previous call are scanned, so the cost doesn't depend on the file size.
+	# The first scan of a file searches it back to the last restart, for its FFT length.
+	# With store, the state of the workdir, the scan is saved for the next runs.
+	with span("parse_stat_file", file=os.path.basename(statfile)) as scan:
+		try:
+			inode = os.stat(statfile).st_ino
+		except (IOError,OSError):
+			stat_cache.pop(statfile, None)
+			return 0, None
+		cached = stat_cache.get(statfile)
+		if cached is None and store is not None:
+			cached = load_stat_scan(store, statfile, inode)
+		saved = cached
+		if cached is not None and cached[0] == inode and os.path.getsize(statfile) >= cached[1]:
+			(_, offset, previous, fft_length) = cached
+		else:
+			(offset, previous, fft_length) = 0, [], None
+		found = []
+		new_fft_length = None
+		new_offset = offset
+		scanned = None # end of the earliest line scanned, the bytes before it are not
+		# get the 5 most recent Iter line
+		for end, line in readonly_reversed_lines(statfile, offset):
+			if new_offset == offset:
+				new_offset = end
+			scanned = end
+			if new_fft_length is None:
+				res = fft_regex.search(line)
+				if res:
+					# Mlucas restarted with this FFT length
+					new_fft_length = int(res.group(1))
+					continue
+			res = stat_regex.search(line)
+			if res:
 				iteration = int(res.group(1))
-			usec_per_iter = float(res.group(2))
-			unit = res.group(3)
-			if unit == "sec":
-				usec_per_iter *= 1000
-			list_usec_per_iter.append(usec_per_iter)
-			if found == 5: break
-	if found == 0: return 0, None # iteration is 0, but don't know the estimated speed yet
-	# take the media of the last grepped lines
-	usec_per_iter = median_low(list_usec_per_iter)
-	return iteration, usec_per_iter
+				usec_per_iter = float(res.group(2))
+				unit = res.group(3)
+				if unit == "sec":
+					usec_per_iter *= 1000
+				# the date is the local time of the computer, only the differences are used
+				date = stat_date_regex.search(line)
+				if date:
+					date = timegm(tuple(int(field) for field in date.groups()))
+				found.append((iteration, usec_per_iter, date))
+				if len(found) == 5: break
+		if new_fft_length is None and scanned is not None:
+			# the last restart in the bytes appended before the lines scanned
+			new_fft_length = read_fft_length(statfile, offset, scanned)
+		found = (found + previous)[:5]
+		if new_fft_length is not None:
+			fft_length = new_fft_length
+		stat_cache[statfile] = (inode, new_offset, found, fft_length)
+		if store is not None and stat_cache[statfile] != saved:
+			save_stat_scan(store, statfile, stat_cache[statfile])
+		scan.set(bytes=new_offset - offset, lines=len(found))
+		if not found: return 0, None # iteration is 0, but don't know the estimated speed yet
+		# keep the last iteration to compute the percent of progress
+		iteration = found[0][0]
+		# take the media of the last grepped lines
+		usec_per_iter = median_low([usec_per_iter for _, usec_per_iter, _ in found])
+		return iteration, usec_per_iter
 
 def parse_v5_resp(r):
 	ans = dict()
@@ -310,25 +618,635 @@ def parse_v5_resp(r):
 		ans[option]=value
 	return ans
 
+class ConnectionPool(object):
+	"""Persistent connections to the servers, shared by all the urllib openers
+	Connections are kept alive between requests and reused, so that a cycle doesn't
+	pay for DNS resolution, TCP and TLS setup on each request."""
+	def __init__(self):
+		self.idle = {} # (connection class, host) -> list of idle connections
+		self.lock = Lock()
+
+	def get(self, http_class, host, timeout):
+		with self.lock:
+			idle = self.idle.get((http_class, host))
+			while idle:
+				conn = idle.pop()
+				# an idle connection is readable only if the server closed it
+				if conn.sock is not None and not select.select([conn.sock], [], [], 0)[0]:
+					return conn, True
+				conn.close()
+		return http_class(host, timeout=timeout), False
+
+	def put(self, http_class, host, conn):
+		with self.lock:
+			self.idle.setdefault((http_class, host), []).append(conn)
+
+	def close(self):
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns:
+					conn.close()
+			self.idle.clear()
+
+	def open(self, http_class, req):
+		# python2 Request has only methods, python3 Request only attributes
+		host = req.get_host() if hasattr(req, "get_host") else req.host
+		selector = req.get_selector() if hasattr(req, "get_selector") else req.selector
+		headers = dict(req.unredirected_hdrs)
+		headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+		headers["Connection"] = "keep-alive"
+		headers["Accept-Encoding"] = "gzip"
+		conn, reused = self.get(http_class, host, req.timeout)
+		try:
+			conn.request(req.get_method(), selector, req.data, headers)
+		except (socket.error, httplib.HTTPException) as e:
+			conn.close()
+			if reused:
+				# the server closed the idle connection before the request was written, try again
+				return self.open(http_class, req)
+			raise URLError(e)
+		try:
+			r = conn.getresponse()
+			data = r.read()
+		except (socket.error, httplib.HTTPException) as e:
+			# the server may have handled the request (a result sent with ar): it is not
+			# sent again here, the caller decides from its digests and outbox
+			conn.close()
+			raise URLError(e)
+		if r.will_close:
+			conn.close()
+		else:
+			self.put(http_class, host, conn)
+		if r.getheader("Content-Encoding", "") == "gzip":
+			data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+			del r.msg["Content-Encoding"]
+		resp = addinfourl(BytesIO(data), r.msg, req.get_full_url())
+		resp.code = r.status
+		resp.msg = r.reason
+		return resp
+
+def import_network():
+	"""Import the HTTP modules and define the handlers using the connection pool, only once
+	urllib and http (with ssl and email) take longer to import than a cycle with nothing
+	to send takes to run, so they are imported before the first request by open_network()"""
+	global cookiejar, socket, httplib, URLError, HTTPError, urlencode, addinfourl
+	global build_opener, install_opener, urlopen, HTTPCookieProcessor, HTTPHandler, HTTPSHandler
+	global KeepAliveHTTPHandler, KeepAliveHTTPSHandler, primenet_cj
+	if primenet_cj is not None:
+		return
+	import socket
+	# More python3-backward-incompatibility-breakage-related foo - thanks to Gord Palameta for the workaround:
+	try:
+		# Python3
+		import http.cookiejar as cookiejar
+		from urllib.error import URLError, HTTPError
+		from urllib.parse import urlencode
+		from urllib.request import build_opener, install_opener, urlopen
+		from urllib.request import HTTPCookieProcessor, HTTPHandler, HTTPSHandler
+		from urllib.response import addinfourl
+		import http.client as httplib
+	except ImportError:
+		# Python2
+		import cookielib as cookiejar
+		from urllib2 import URLError, HTTPError
+		from urllib import urlencode
+		from urllib2 import build_opener, install_opener, urlopen
+		from urllib2 import HTTPCookieProcessor, HTTPHandler, HTTPSHandler
+		from urllib2 import addinfourl
+		import httplib
+
+	# The double inheritance with object is necessary in Python2 to have new style classes,
+	# so that they can be combined with the urllib_debug Spy handlers.
+	class KeepAliveHTTPHandler(HTTPHandler, object):
+		def __init__(self, pool):
+			HTTPHandler.__init__(self)
+			self.pool = pool
+
+		def http_open(self, req):
+			return self.pool.open(httplib.HTTPConnection, req)
+
+	class KeepAliveHTTPSHandler(HTTPSHandler, object):
+		def __init__(self, pool):
+			HTTPSHandler.__init__(self)
+			self.pool = pool
+
+		def https_open(self, req):
+			if getattr(req, "_tunnel_host", None):
+				# HTTPS through a proxy, not handled by the pool
+				return HTTPSHandler.https_open(self, req)
+			return self.pool.open(httplib.HTTPSConnection, req)
+
+	# adapted from http://stackoverflow.com/questions/923296/keeping-a-session-in-python-while-making-http-requests
+	primenet_cj = cookiejar.MozillaCookieJar()
+
+def install_openers(http_handler=None, https_handler=None):
+	"""Build the opener for www.mersenne.org, with cookies, and the default one used for the v5 API
+	Both use the connection pool, with the keep-alive handlers by default."""
+	global primenet
+	import_network()
+	http_handler = http_handler or KeepAliveHTTPHandler
+	https_handler = https_handler or KeepAliveHTTPSHandler
+	primenet = build_opener(HTTPCookieProcessor(primenet_cj), http_handler(connection_pool), https_handler(connection_pool))
+	install_opener(build_opener(http_handler(connection_pool), https_handler(connection_pool)))
+
+network_lock = Lock()
+def open_network():
+	"""Called before each request: the first one builds the openers and restores the session
+	of www.mersenne.org, so that a cycle with nothing to send makes no import for them"""
+	global cookies_loaded
+	with network_lock:
+		if primenet is None:
+			install_openers()
+		if not cookies_loaded and cookies_file is not None:
+			cookies_loaded = True
+			load_cookies(cookies_file)
+
+from random import uniform
+class RetryScheduler(object):
+	"""Retry the v5 requests which failed because of the network or a busy server,
+	waiting between the tries with an exponential backoff and some jitter, so that
+	the requests of several clients don't hit the server at the same time.
+	After max_failures consecutive failures, the circuit breaker stops all the v5
+	requests during cooling_period seconds, then lets them try again. The failures
+	and the cooling period are saved with the state, for the next run from cron."""
+	def __init__(self, max_tries=3, base_delay=10, max_delay=300, max_failures=5, cooling_period=30*60):
+		self.max_tries = max_tries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.max_failures = max_failures
+		self.cooling_period = cooling_period
+		self.failures = 0 # consecutive failures, for all the requests
+		self.open_until = None # end of the cooling period when the circuit is open
+		self.lock = Lock()
+
+	def delay(self, attempt):
+		"""Delay before the retry following the given attempt (0 for the first one)"""
+		backoff = min(self.max_delay, self.base_delay * 2**attempt)
+		return backoff/2 + uniform(0, backoff/2)
+
+	def allow(self):
+		"""Tell if a request can be sent, i.e. the circuit is closed"""
+		with self.lock:
+			if self.open_until is None:
+				return True
+			if now() < self.open_until:
+				return False
+			# half open: the next failure opens the circuit again
+			self.open_until = None
+			self.failures = self.max_failures - 1
+			return True
+
+	def remaining(self):
+		"""Seconds until the circuit lets the requests try again, 0 if it is closed"""
+		with self.lock:
+			if self.open_until is None:
+				return 0
+			return max(0, self.open_until - now())
+
+	def success(self):
+		with self.lock:
+			self.failures = 0
+
+	def failure(self):
+		"""Count a failure, return True if it opens the circuit"""
+		with self.lock:
+			self.failures += 1
+			if self.failures >= self.max_failures and self.open_until is None:
+				self.open_until = now() + self.cooling_period
+				return True
+			return False
+
+	def load(self, state):
+		"""Restore the failures and the cooling period of the previous run"""
+		if state.has_option("primenet", "retry_failures"):
+			self.failures = int(state.get("primenet", "retry_failures"))
+		if state.has_option("primenet", "retry_open_until"):
+			self.open_until = float(state.get("primenet", "retry_open_until"))
+			if now() < self.open_until:
+				debug_print("{0} failures in a row in the previous runs, no request sent to the server during {1:.0f} minutes".format(self.failures, (self.open_until - now())/60))
+
+	def save(self, state):
+		"""Save the failures and the cooling period if they have changed"""
+		with self.lock:
+			values = (("retry_failures", str(self.failures) if self.failures else None),
+				("retry_open_until", "{0:.0f}".format(self.open_until) if self.open_until is not None else None))
+		updated = False
+		for key, value in values:
+			previous = state.get("primenet", key) if state.has_option("primenet", key) else None
+			if value == previous:
+				continue
+			if value is None:
+				state.remove_option("primenet", key)
+			else:
+				state.set("primenet", key, value)
+			updated = True
+		if updated:
+			state.commit()
+
+class Metrics(object):
+	"""Numbers of what primenet.py does, exported in the Prometheus text format, either
+	as a file for the textfile collector of node_exporter (--metrics) or on a port (--metrics_listen).
+	The series are identified by their name and their labels, given as a dict."""
+	buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+	descriptions = OrderedDict((
+		("primenet_cycle_timestamp_seconds", ("gauge", "Date of the end of the last cycle")),
+		("primenet_phase_duration_seconds", ("gauge", "Duration of each phase of the last cycle, the login is also counted in the phase which needed it")),
+		("primenet_requests_total", ("counter", "Requests sent, by endpoint")),
+		("primenet_request_duration_seconds", ("histogram", "Duration of the requests, by endpoint")),
+		("primenet_request_bytes_total", ("counter", "Bytes sent and received, by endpoint")),
+		("primenet_v5_results_total", ("counter", "Answers of the v5 API by transaction and error code, or HTTP status, or network for a connection error")),
+		("primenet_queue_assignments", ("gauge", "Assignments in worktodo.ini")),
+		("primenet_assignment_percent", ("gauge", "Progress of the assignment")),
+		("primenet_assignment_iterations_per_second", ("gauge", "Estimated speed of the assignment")),
+		("primenet_assignment_eta_seconds", ("gauge", "Estimated time until the end of the assignment")),
+		("primenet_outbox_pending", ("gauge", "Results and progress updates waiting to be sent, by type")),
+	))
+
+	def __init__(self):
+		self.lock = Lock()
+		self.values = OrderedDict() # (name, labels) -> value
+		self.histograms = OrderedDict() # (name, labels) -> [count for each bucket, sum, count]
+
+	@staticmethod
+	def key(name, labels):
+		return (name, tuple(sorted(labels.items())))
+
+	def set(self, name, labels, value):
+		with self.lock:
+			self.values[self.key(name, labels)] = value
+
+	def inc(self, name, labels, value=1):
+		key = self.key(name, labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + value
+
+	def observe(self, name, labels, value):
+		key = self.key(name, labels)
+		with self.lock:
+			histogram = self.histograms.setdefault(key, [0]*len(self.buckets) + [0, 0])
+			for i, bucket in enumerate(self.buckets):
+				if value <= bucket:
+					histogram[i] += 1
+			histogram[-2] += value
+			histogram[-1] += 1
+
+	def request(self, endpoint, duration, sent, received):
+		labels = {"endpoint": endpoint}
+		self.inc("primenet_requests_total", labels)
+		self.observe("primenet_request_duration_seconds", labels, duration)
+		self.inc("primenet_request_bytes_total", {"endpoint": endpoint, "direction": "sent"}, sent)
+		self.inc("primenet_request_bytes_total", {"endpoint": endpoint, "direction": "received"}, received)
+
+	def forget(self, name, **labels):
+		"""Remove the series of name having these labels, e.g. the assignments no longer in worktodo.ini"""
+		with self.lock:
+			for key in [key for key in self.values if key[0] == name and set(labels.items()) <= set(key[1])]:
+				del self.values[key]
+
+	@staticmethod
+	def format_labels(labels, extra=()):
+		labels = list(labels) + list(extra)
+		if not labels:
+			return ""
+		return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels) + "}"
+
+	def render(self):
+		lines = []
+		with self.lock:
+			for name, (kind, description) in self.descriptions.items():
+				values = [(key[1], value) for key, value in self.values.items() if key[0] == name]
+				histograms = [(key[1], value) for key, value in self.histograms.items() if key[0] == name]
+				if not values and not histograms:
+					continue
+				lines.append("# HELP {0} {1}".format(name, description))
+				lines.append("# TYPE {0} {1}".format(name, kind))
+				for labels, value in values:
+					lines.append("{0}{1} {2}".format(name, self.format_labels(labels), repr(float(value))))
+				for labels, histogram in histograms:
+					for bucket, count in zip(self.buckets, histogram):
+						lines.append("{0}_bucket{1} {2}".format(name, self.format_labels(labels, [("le", repr(float(bucket)))]), count))
+					lines.append("{0}_bucket{1} {2}".format(name, self.format_labels(labels, [("le", "+Inf")]), histogram[-1]))
+					lines.append("{0}_sum{1} {2}".format(name, self.format_labels(labels), repr(float(histogram[-2]))))
+					lines.append("{0}_count{1} {2}".format(name, self.format_labels(labels), histogram[-1]))
+		return "\n".join(lines) + "\n"
+
+def write_metrics(filename):
+	"""Write the metrics for the textfile collector, replacing the file atomically
+	so that node_exporter never reads a partial file"""
+	try:
+		with replace_file(filename) as File:
+			File.write(metrics.render())
+	except (IOError, OSError) as e:
+		debug_print("ERROR writing {0}: {1}".format(filename, e), file=sys.stderr)
+
+def serve_metrics(listen):
+	"""Serve the metrics on [address:]port in a thread, the address is 127.0.0.1 by default"""
+	try:
+		from http.server import BaseHTTPRequestHandler, HTTPServer
+	except ImportError:
+		from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	class MetricsHandler(BaseHTTPRequestHandler, object):
+		def do_GET(self):
+			body = metrics.render().encode("utf-8")
+			self.send_response(200)
+			self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		def log_message(self, format, *args):
+			pass
+	address, _, port = listen.rpartition(":")
+	server = HTTPServer((address or "127.0.0.1", int(port)), MetricsHandler)
+	from threading import Thread
+	thread = Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	debug_print("Serving the metrics on http://{0}:{1}/metrics".format(*server.server_address))
+	return server
+
+def measure_phase(phase, func, *args):
+	"""Call func(*args) and save its duration as the phase of the current workdir"""
+	start = now()
+	try:
+		with span(phase, workdir=workdir):
+			return func(*args)
+	finally:
+		metrics.set("primenet_phase_duration_seconds", {"workdir": workdir, "phase": phase}, now() - start)
+
+class Profiler(object):
+	"""Profile each cycle with cProfile (--profile) and report the lines allocating
+	the most memory since the start with tracemalloc (--tracemalloc)"""
+	def __init__(self, filename, keep=10, top=0):
+		import cProfile
+		self.cProfile = cProfile
+		self.filename = filename
+		self.keep = keep
+		self.top = top
+		self.profile = None
+		self.last = None # profile of the last cycle
+		self.tracemalloc = None
+		self.baseline = None
+		if top > 0:
+			try:
+				import tracemalloc # Python 3.4+
+			except ImportError:
+				debug_print("WARNING: tracemalloc needs Python 3.4 or later, no allocation report", file=sys.stderr)
+			else:
+				tracemalloc.start()
+				self.tracemalloc = tracemalloc
+				self.baseline = tracemalloc.take_snapshot()
+
+	def start(self):
+		self.profile = self.cProfile.Profile()
+		self.profile.enable()
+
+	def stop(self):
+		"""Save the profile of the cycle to filename, the previous ones are kept as filename.1, filename.2..."""
+		self.profile.disable()
+		self.last, self.profile = self.profile, None
+		try:
+			for n in range(self.keep - 1, 0, -1):
+				older = self.filename if n == 1 else "{0}.{1}".format(self.filename, n - 1)
+				if os.path.exists(older):
+					replace(older, "{0}.{1}".format(self.filename, n))
+			self.last.dump_stats(self.filename)
+		except (IOError, OSError) as e:
+			debug_print("ERROR writing {0}: {1}".format(self.filename, e), file=sys.stderr)
+		if self.tracemalloc is not None:
+			debug_print(self.allocations())
+
+	def allocations(self):
+		snapshot = self.tracemalloc.take_snapshot().filter_traces([self.tracemalloc.Filter(False, self.tracemalloc.__file__)])
+		lines = ["Top {0} allocations since the start, {1:.1f} MB traced:".format(self.top, self.tracemalloc.get_traced_memory()[0]/1024/1024)]
+		lines.extend("  " + str(stat) for stat in snapshot.compare_to(self.baseline, "lineno")[:self.top])
+		return "\n".join(lines)
+
+	def report(self, signum=None, frame=None):
+		"""Print the functions taking the most time in the last cycle and the allocations, on SIGUSR1"""
+		if self.last is not None:
+			import pstats
+			stream = StringIO()
+			pstats.Stats(self.last, stream=stream).sort_stats("cumulative").print_stats(20)
+			debug_print("Profile of the last cycle, saved in {0}:\n{1}".format(self.filename, stream.getvalue()))
+		if self.tracemalloc is not None:
+			debug_print(self.allocations())
+
+def profile_cycle(func, *args):
+	"""Call func(*args), profiled if --profile is given"""
+	if profiler is None:
+		return func(*args)
+	profiler.start()
+	try:
+		return func(*args)
+	finally:
+		profiler.stop()
+
+class Span(object):
+	"""An operation of a cycle, with its duration, its parent and its attributes"""
+	__slots__ = ("name", "attributes", "kind", "trace_id", "span_id", "parent_id", "thread", "start", "end")
+	def __init__(self, name, attributes, kind):
+		self.name = name
+		self.attributes = attributes
+		self.kind = kind
+
+	def set(self, **attributes):
+		self.attributes.update(attributes)
+
+	def __enter__(self):
+		tracer.enter(self)
+		self.start = time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.end = time()
+		if exc_type is not None:
+			self.attributes["error"] = exc_type.__name__
+		tracer.exit(self)
+		return False
+
+class NullSpan(object):
+	"""The span of all operations when the tracing is disabled, it does nothing"""
+	def set(self, **attributes):
+		pass
+	def __enter__(self):
+		return self
+	def __exit__(self, exc_type, exc_value, tb):
+		return False
+null_span = NullSpan()
+
+def span(name, kind="internal", **attributes):
+	"""Context manager tracing the operation name, kind is "client" for the network transactions"""
+	if tracer is None:
+		return null_span
+	return Span(name, attributes, kind)
+
+class Tracer(object):
+	"""Collect the spans of each cycle (--trace) and append them to a file, as Chrome trace
+	events (chrome://tracing, https://ui.perfetto.dev) or as OTLP-JSON lines for OpenTelemetry"""
+	def __init__(self, filename, format="chrome"):
+		self.filename = filename
+		self.format = format
+		self.lock = Lock()
+		self.spans = []
+		self.local = local() # stack of the open spans of each thread
+		self.trace_id = self.new_id(16)
+		self.next_id = 1
+
+	@staticmethod
+	def new_id(size):
+		return "".join("{0:02x}".format(b) for b in bytearray(os.urandom(size)))
+
+	def new_trace(self):
+		"""The spans of each cycle belong to a new trace"""
+		self.trace_id = self.new_id(16)
+
+	def current(self):
+		"""Return the innermost open span of the current thread, or None"""
+		stack = getattr(self.local, "stack", None)
+		return stack[-1] if stack else None
+
+	def attach(self, parent):
+		"""Make parent, opened by another thread, the parent of the next spans of the current thread"""
+		self.local.stack = [parent] if parent is not None else []
+
+	def enter(self, span):
+		stack = getattr(self.local, "stack", None)
+		if stack is None:
+			stack = self.local.stack = []
+		with self.lock:
+			span.span_id = "{0:016x}".format(self.next_id)
+			self.next_id += 1
+		span.trace_id = self.trace_id
+		span.parent_id = stack[-1].span_id if stack else None
+		span.thread = get_ident()
+		stack.append(span)
+
+	def exit(self, span):
+		self.local.stack.pop()
+		with self.lock:
+			self.spans.append(span)
+
+	def chrome_events(self, spans):
+		pid = os.getpid()
+		for span in spans:
+			yield {"name": span.name, "cat": span.kind, "ph": "X", "pid": pid, "tid": span.thread,
+				"ts": int(span.start*1e6), "dur": int((span.end - span.start)*1e6), "args": span.attributes}
+
+	@staticmethod
+	def otlp_value(value):
+		if isinstance(value, bool):
+			return {"boolValue": value}
+		if isinstance(value, int) or (sys.version_info[0] < 3 and isinstance(value, long)):
+			return {"intValue": str(value)}
+		if isinstance(value, float):
+			return {"doubleValue": value}
+		return {"stringValue": str(value)}
+
+	def otlp_request(self, spans):
+		# https://opentelemetry.io/docs/specs/otlp/#json-protobuf-encoding
+		kinds = {"internal": 1, "client": 3}
+		otlp_spans = []
+		for span in spans:
+			otlp_span = OrderedDict((
+				("traceId", span.trace_id),
+				("spanId", span.span_id),
+				("name", span.name),
+				("kind", kinds[span.kind]),
+				("startTimeUnixNano", str(int(span.start*1e9))),
+				("endTimeUnixNano", str(int(span.end*1e9))),
+				("attributes", [{"key": key, "value": self.otlp_value(value)} for key, value in sorted(span.attributes.items())]),
+			))
+			if span.parent_id is not None:
+				otlp_span["parentSpanId"] = span.parent_id
+			if "error" in span.attributes:
+				otlp_span["status"] = {"code": 2, "message": span.attributes["error"]}
+			otlp_spans.append(otlp_span)
+		resource = {"attributes": [{"key": "service.name", "value": {"stringValue": "primenet.py"}},
+			{"key": "process.pid", "value": {"intValue": str(os.getpid())}}]}
+		return {"resourceSpans": [{"resource": resource, "scopeSpans": [{"scope": {"name": "primenet.py"}, "spans": otlp_spans}]}]}
+
+	def flush(self):
+		"""Append the spans ended since the previous call to the file, the next ones belong to a new trace"""
+		with self.lock:
+			spans, self.spans = self.spans, []
+		self.new_trace()
+		if not spans:
+			return
+		spans.sort(key=lambda span: span.start)
+		try:
+			with open(self.filename, "a") as File:
+				if self.format == "otlp":
+					# one request by line, as the file exporter of the OpenTelemetry collector
+					File.write(json.dumps(self.otlp_request(spans)) + "\n")
+				else:
+					# JSON array format, whose closing ] is optional, so that the events can be appended
+					if File.tell() == 0:
+						File.write("[\n")
+					for event in self.chrome_events(spans):
+						File.write(json.dumps(event, sort_keys=True) + ",\n")
+		except (IOError, OSError) as e:
+			debug_print("ERROR writing {0}: {1}".format(self.filename, e), file=sys.stderr)
+
 def send_request(guid, args):
+	"""Send a v5 request, retrying it on transient errors as scheduled by retry_scheduler
+	Return the parsed answer, still ERROR_SERVER_BUSY if the server was busy for all the tries,
+	or None if the server could not be reached"""
 	args["g"] = guid
+	open_network()
 	# to mimic mprime, it is necessary to add safe='"{}:,' argument to urlencode, in
 	# particular to encode JSON in result submission. But safe is not supported by python2...
-	url_args = urlencode(args)
-	# Only really usefull for t = "uc", not for "ap", is it for "ar" ?
-	url_args += "&ss=19191919&sh=ABCDABCDABCDABCDABCDABCDABCDABCD"
-	try:
-		# don't need to use primenet opener because this API doesn't have cookies
-		r = urlopen(primenet_v5_burl+url_args)
-	except HTTPError as e:
-		debug_print("ERROR receiving answer to request: "+str(primenet_v5_burl+url_args), file=sys.stderr)
-		debug_print(e, file=sys.stderr)
-		return None
-	except URLError as e:
-		debug_print("ERROR connecting to server for request: "+str(primenet_v5_burl+url_args), file=sys.stderr)
-		debug_print(e, file=sys.stderr)
-		return None
-	return parse_v5_resp(r.read().decode("utf-8","replace"))
+	# The key derived from guid is cached, so signing is only a MD5 of the arguments
+	url_args = add_secure_v5_args(urlencode(args), guid)
+	result = None
+	for attempt in range(retry_scheduler.max_tries):
+		if not retry_scheduler.allow():
+			return None
+		with span("v5 " + args["t"], "client", t=args["t"], attempt=attempt) as request:
+			start = now()
+			data = b""
+			try:
+				# don't need to use primenet opener because this API doesn't have cookies,
+				# the default opener shares the connection pool with it
+				r = urlopen(primenet_v5_burl+url_args)
+				data = r.read()
+				result = parse_v5_resp(data.decode("utf-8","replace"))
+				code = result["pnErrorResult"]
+				transient = int(code) == primenet_api.ERROR_SERVER_BUSY
+			except HTTPError as e:
+				debug_print("ERROR receiving answer to request: "+str(primenet_v5_burl+url_args), file=sys.stderr)
+				debug_print(e, file=sys.stderr)
+				result = None
+				code = e.code
+				# only the server errors are worth a retry
+				transient = e.code >= 500 or e.code == 429
+			except URLError as e:
+				debug_print("ERROR connecting to server for request: "+str(primenet_v5_burl+url_args), file=sys.stderr)
+				debug_print(e, file=sys.stderr)
+				result = None
+				code = "network"
+				transient = True
+			metrics.request("v5:" + args["t"], now() - start, len(primenet_v5_burl+url_args), len(data))
+			metrics.inc("primenet_v5_results_total", {"transaction": args["t"], "code": code})
+			request.set(code=code, bytes_sent=len(primenet_v5_burl+url_args), bytes_received=len(data))
+			if "k" in args:
+				request.set(assignment=args["k"])
+			if "n" in args:
+				request.set(exponent=args["n"])
+		if not transient:
+			# only an answer of the server closes the circuit, a client error (4xx)
+			# doesn't tell if the server works
+			if result is not None:
+				retry_scheduler.success()
+			return result
+		if retry_scheduler.failure():
+			debug_print("{0} failures in a row, no request sent to the server during {1} minutes".format(retry_scheduler.failures, retry_scheduler.cooling_period//60), file=sys.stderr)
+			break
+		if attempt + 1 < retry_scheduler.max_tries:
+			delay = retry_scheduler.delay(attempt)
+			debug_print("Server {0}, retrying in {1:.1f} seconds".format("busy" if result else "error", delay))
+			with span("backoff", delay=delay):
+				backoff_sleep(delay)
+	return result
 
 from random import getrandbits
 def create_new_guid():
@@ -368,7 +1286,9 @@ def register_instance(guid):
 	if guid is None:
 		guid = create_new_guid()
 	result = send_request(guid, args)
-	if result is None:
+	if result is None and retry_scheduler.remaining() > 0:
+		parser.error("Not registering on mersenne.org, {0} failures in a row, no request sent to the server during {1:.0f} minutes".format(retry_scheduler.failures, retry_scheduler.remaining()/60))
+	elif result is None:
 		parser.error("Error while registering on mersenne.org")
 	elif int(result["pnErrorResult"]) != 0:
 		parser.error("Error while registering on mersenne.org\nReason: "+result["pnErrorDetail"])
@@ -389,6 +1309,29 @@ def register_instance(guid):
 	print("https://www.mersenne.org/editcpu/?g={guid}".format(guid=guid))
 	return
 
+# registrations asked by the requests in flight which got an error: guid which got
+# the error -> guid to register (None to pick a new one). register_instance exits on
+# error with parser.error, so they are done by flush_outbox() in the main thread.
+reregistrations = {}
+registration_lock = Lock()
+def reregister_later(old_guid, new_guid):
+	"""Ask to register again after an error, only once if several requests
+	in flight get the error for the same guid"""
+	with registration_lock:
+		if reregistrations.get(old_guid, old_guid) is not None:
+			reregistrations[old_guid] = new_guid
+
+def reregister_instances():
+	"""Do the registrations asked by reregister_later(), return True if there was any"""
+	with registration_lock:
+		todo = list(reregistrations.items())
+		reregistrations.clear()
+	for old_guid, new_guid in todo:
+		if get_guid(config) == old_guid:
+			with span("register_instance", new_guid=new_guid is None):
+				register_instance(new_guid)
+	return len(todo) > 0
+
 def config_read():
 	config = ConfigParser(dict_type=OrderedDict)
 	try:
@@ -411,9 +1354,164 @@ def config_write(config, guid=None):
 	# generate a new local.ini file
 	if guid is not None: # update the guid if necessary
 		config.set("primenet", "guid", guid)
-	with open(localfile, "w") as configfile:
+	with replace_file(localfile) as configfile:
 		config.write(configfile)
 
+class StateStore(object):
+	"""State kept by primenet.py between the runs for a workdir, in primenet.db, a SQLite database
+	in WAL mode: the progress sent for each assignment, the speed measured for each FFT length,
+	the throughput of the current test, the offset in results.txt and in the p*.stat files, the work preference sent,
+	with the same sections and options as they had in local.ini, and the digests of the results
+	already sent. The rows are read once, each change is a single row write, and the changes of
+	a cycle are saved together by commit(), instead of rewriting local.ini."""
+	sections = ("progress", "fft_speed", "throughput", "stat_scan")
+	primenet_options = ("usec_per_iter", "results_offset", "results_fingerprint", "work_preference", "retry_failures", "retry_open_until")
+
+	def __init__(self, filename):
+		import sqlite3
+		self.filename = filename
+		self.created = not os.path.exists(filename)
+		self.lock = Lock() # progress updates are sent from several threads
+		self.db = sqlite3.connect(filename, check_same_thread=False)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		# a crash can only lose the last commits, which are then done again
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("CREATE TABLE IF NOT EXISTS state (section TEXT, key TEXT, value TEXT, PRIMARY KEY (section, key))")
+		self.db.execute("CREATE TABLE IF NOT EXISTS sent (digest TEXT PRIMARY KEY)")
+		self.values = OrderedDict()
+		for section, key, value in self.db.execute("SELECT section, key, value FROM state ORDER BY rowid"):
+			self.values.setdefault(section, OrderedDict())[key] = value
+
+	# same methods as ConfigParser, the options are not case sensitive either
+	def has_section(self, section):
+		return section in self.values
+
+	def add_section(self, section):
+		self.values.setdefault(section, OrderedDict())
+
+	def has_option(self, section, key):
+		return key.lower() in self.values.get(section, ())
+
+	def options(self, section):
+		return list(self.values.get(section, ()))
+
+	def get(self, section, key):
+		try:
+			return self.values[section][key.lower()]
+		except KeyError:
+			raise NoOptionError(key, section)
+
+	def set(self, section, key, value):
+		with self.lock:
+			self.values.setdefault(section, OrderedDict())[key.lower()] = value
+			self.db.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?)", (section, key.lower(), value))
+
+	def remove_option(self, section, key):
+		with self.lock:
+			if self.values.get(section, {}).pop(key.lower(), None) is not None:
+				self.db.execute("DELETE FROM state WHERE section = ? AND key = ?", (section, key.lower()))
+
+	def commit(self):
+		with self.lock:
+			self.db.commit()
+			if dump_state:
+				# the database file can't be compared by the tests, its content can
+				write_list_file(self.filename + ".sql", list(self.db.iterdump()))
+
+	def is_sent(self, digest):
+		with self.lock:
+			return self.db.execute("SELECT 1 FROM sent WHERE digest = ?", (digest,)).fetchone() is not None
+
+	def sent_index(self):
+		return SentIndex(self)
+
+	def add_sent(self, digests):
+		# committed right away, as the line appended to results_sent.txt
+		with self.lock:
+			self.db.executemany("INSERT OR IGNORE INTO sent VALUES (?)", ((digest,) for digest in digests))
+		self.commit()
+
+	def keep_sent(self, digests):
+		"""Remove the digests not in digests, return the number of digests kept and removed"""
+		with self.lock:
+			removed = [row for row in self.db.execute("SELECT digest FROM sent") if row[0] not in digests]
+			self.db.executemany("DELETE FROM sent WHERE digest = ?", removed)
+			kept = self.db.execute("SELECT COUNT(*) FROM sent").fetchone()[0]
+		self.commit()
+		return kept, len(removed)
+
+class SentIndex(object):
+	"""Digests of the results already sent, looked up one by one in primenet.db"""
+	def __init__(self, store):
+		self.store = store
+
+	def __contains__(self, digest):
+		return self.store.is_sent(digest)
+
+class IniState(object):
+	"""The state kept in local.ini and results_sent.idx, when Python is built without SQLite"""
+	def __init__(self, config):
+		self.config = config
+
+	def __getattr__(self, name):
+		# has_section, get, set... of local.ini
+		return getattr(self.config, name)
+
+	def commit(self):
+		config_write(self.config)
+
+	def sent_index(self):
+		"""Return the set of the digests of the results already sent
+		The index is built from results_sent.txt the first time it is needed."""
+		if os.path.exists(sentindexfile):
+			return set(readonly_list_file(sentindexfile))
+		if not os.path.exists(sentfile):
+			return set()
+		sent_digests = set(result_digest(line) for line in readonly_list_file(sentfile))
+		write_list_file(sentindexfile, sorted(sent_digests))
+		return sent_digests
+
+	def add_sent(self, digests):
+		write_list_file(sentindexfile, digests, "a")
+
+	def keep_sent(self, digests):
+		sent_digests = self.sent_index()
+		kept = sent_digests & digests
+		write_list_file(sentindexfile, sorted(kept))
+		return len(kept), len(sent_digests) - len(kept)
+
+def open_state():
+	"""Open the state of the current workdir, in primenet.db if Python has SQLite
+	The state saved in local.ini and results_sent.idx by the previous versions is moved to it."""
+	try:
+		store = StateStore(statefile)
+	except ImportError:
+		return IniState(config)
+	moved = False
+	for section in StateStore.sections:
+		if config.has_section(section):
+			for key in config.options(section):
+				store.set(section, key, config.get(section, key))
+			config.remove_section(section)
+			moved = True
+	for key in StateStore.primenet_options:
+		if config.has_option("primenet", key):
+			store.set("primenet", key, config.get("primenet", key))
+			config.remove_option("primenet", key)
+			moved = True
+	if os.path.exists(sentindexfile):
+		store.add_sent(readonly_list_file(sentindexfile))
+		os.remove(sentindexfile)
+		debug_print("{0} moved to {1}".format(sentindexfile, statefile))
+	elif store.created and os.path.exists(sentfile):
+		store.add_sent(set(result_digest(line) for line in readonly_list_file(sentfile)))
+	store.commit()
+	if moved:
+		# local.ini keeps only the settings of the user
+		debug_print("State moved from {0} to {1}".format(localfile, statefile))
+		config_write(config)
+	return store
+
 def merge_config_and_options(config, options):
 	# getattr and setattr allow access to the options.xxxx values by name
 	# which allow to copy all of them programmatically instead of having
@@ -443,11 +1541,16 @@ def merge_config_and_options(config, options):
 			updated = True
 	return updated
 
-Assignment = namedtuple('Assignment', "id p is_prp iteration usec_per_iter")
+Assignment = namedtuple('Assignment', "id p is_prp iteration usec_per_iter fft_length")
 def update_progress():
 	w = readonly_list_file(workfile)
 	tasks = greplike(workpattern, w)
-	if not len(tasks): return # don't update if no worktodo
+	metrics.set("primenet_queue_assignments", {"workdir": workdir}, len(tasks))
+	for name in ("primenet_assignment_percent", "primenet_assignment_iterations_per_second", "primenet_assignment_eta_seconds"):
+		metrics.forget(name, workdir=workdir)
+	if not len(tasks):
+		next_update.pop(workdir, None)
+		return # don't update if no worktodo
 	config_updated = False
 	# Treat the first assignment. Only this one is used to save the usec_per_iter
 	# The idea is that the first assignment is having a .stat file with correct values
@@ -457,36 +1560,162 @@ def update_progress():
 	# Using usec_per_iter from one p to another is a good estimation if both p are close enougth
 	# if there is big gap, it will be other or under estimated.
 	# Any idea for a better estimation of assignment duration when only p and type (LL or PRP) is known ?
+	# The speed measured for each FFT length is kept in the state (primenet.db), so that the assignments
+	# using another FFT length are estimated from the nearest one
+	speed_table = read_speed_table(state)
 	assignment = get_progress_assignment(tasks[0])
+	head_p = assignment.p
 	usec_per_iter = assignment.usec_per_iter
 	if usec_per_iter is not None:
-		config.set("primenet", "usec_per_iter", "{0:.2f}".format(usec_per_iter))
+		state.set("primenet", "usec_per_iter", "{0:.2f}".format(usec_per_iter))
+		if assignment.fft_length is not None:
+			if not state.has_section("fft_speed"):
+				state.add_section("fft_speed")
+			state.set("fft_speed", str(assignment.fft_length), "{0:.2f}".format(usec_per_iter))
+			speed_table[assignment.fft_length] = usec_per_iter
 		config_updated = True
-	elif config.has_option("primenet", "usec_per_iter"):
-		# If not speed available, get it from the local.ini file
-		usec_per_iter = float(config.get("primenet", "usec_per_iter"))
+	else:
+		usec_per_iter = estimate_usec_per_iter(assignment.p, assignment.fft_length, speed_table)
+		if usec_per_iter is None and state.has_option("primenet", "usec_per_iter"):
+			# If not speed available, get the last one measured
+			usec_per_iter = float(state.get("primenet", "usec_per_iter"))
+	# The dates of the Iter lines tell how fast the test really progresses, including
+	# the pauses of the computer, the restarts and the throttling
+	duty_cycle = update_throughput(assignment.p, stat_dates(stat_filename(assignment.p)), usec_per_iter)
+	if duty_cycle is not None:
+		debug_print("Throughput is {0:.1f}% of the computing speed".format(100*duty_cycle))
+		usec_per_iter /= duty_cycle
 	percent, time_left = compute_progress(assignment.p, assignment.iteration, usec_per_iter)
 	debug_print("p:{0} is {1:.2f}% done".format(assignment.p, percent))
 	if time_left is None:
 		debug_print("Finish cannot be estimated")
 	else:
 		debug_print("Finish estimated in {0:.1f} days (used {1:.1f} msec/iter estimation)".format(time_left/3600/24, usec_per_iter))
-	send_progress(assignment.id, assignment.is_prp, percent, time_left)
+	# the next update is planned from the end of the first assignment, it is sent as d= to the server
+	next_update[workdir] = next_check_in(time_left)
+	assignment_metrics(assignment, percent, time_left, usec_per_iter)
+	# The progress of all the assignments is computed first, in worktodo order,
+	# then sent with several requests in flight
+	updates = [(assignment.id, assignment.is_prp, percent, time_left)]
 	# Do the other assignment accumulating the time_lefts
 	cur_time_left = time_left
+	exponents = set([str(head_p)])
 	for task in tasks[1:]:
 		assignment = get_progress_assignment(task)
-		percent, time_left = compute_progress(assignment.p, assignment.iteration, usec_per_iter)
+		exponents.add(str(assignment.p))
+		task_usec_per_iter = estimate_usec_per_iter(assignment.p, assignment.fft_length, speed_table)
+		if task_usec_per_iter is None:
+			task_usec_per_iter = usec_per_iter
+		elif duty_cycle is not None:
+			task_usec_per_iter /= duty_cycle
+		percent, time_left = compute_progress(assignment.p, assignment.iteration, task_usec_per_iter)
 		debug_print("p:{0} is {1:.2f}% done".format(assignment.p, percent))
 		if time_left is None:
 			debug_print("Finish cannot be estimated")
 		else:
 			cur_time_left += time_left
-			debug_print("Finish estimated in {0:.1f} days (used {1:.1f} msec/iter estimation)".format(cur_time_left/3600/24, usec_per_iter))
-		send_progress(assignment.id, assignment.is_prp, percent, cur_time_left)
-	config_write(config)
+			debug_print("Finish estimated in {0:.1f} days (used {1:.1f} msec/iter estimation)".format(cur_time_left/3600/24, task_usec_per_iter))
+		assignment_metrics(assignment, percent, cur_time_left if time_left is not None else None, task_usec_per_iter)
+		updates.append((assignment.id, assignment.is_prp, percent, cur_time_left))
+	# forget the assignments which are not in worktodo any more
+	if state.has_section("progress"):
+		ids = set(update[0].lower() for update in updates)
+		for assignment_id in state.options("progress"):
+			if assignment_id.lower() not in ids:
+				state.remove_option("progress", assignment_id)
+	if state.has_section("throughput"):
+		for p in state.options("throughput"):
+			if p != str(head_p):
+				state.remove_option("throughput", p)
+	if state.has_section("stat_scan"):
+		for p in state.options("stat_scan"):
+			if p not in exponents:
+				state.remove_option("stat_scan", p)
+	updates = [update for update in updates if progress_update_needed(*update)]
+	outbox_append([{"key": "ap:" + update[0], "t": "ap", "args": list(update)} for update in updates])
+	flush_outbox()
+	state.commit()
 	return percent, cur_time_left
 
+def assignment_metrics(assignment, percent, time_left, usec_per_iter):
+	labels = {"workdir": workdir, "assignment": assignment.id, "exponent": assignment.p}
+	metrics.set("primenet_assignment_percent", labels, percent)
+	if usec_per_iter:
+		metrics.set("primenet_assignment_iterations_per_second", labels, 1e6/usec_per_iter)
+	if time_left is not None:
+		metrics.set("primenet_assignment_eta_seconds", labels, time_left)
+
+def progress_update_needed(assignment_id, is_prp, percent, time_left):
+	"""Tell if the progress of the assignment must be sent to the server
+	It is needed if the assignment is new, if its progress or ETA has changed since
+	the last update, or if the server expects a check-in before the next cycle."""
+	try:
+		last_percent, last_eta, last_time, last_d = state.get("progress", assignment_id).split(",")
+		(last_eta, last_time, last_d) = int(last_eta), int(last_time), int(last_d)
+	except (ConfigParserError, ValueError):
+		return True
+	elapsed = now() - last_time
+	next_check = next_update.get(workdir, options.timeout) if options.timeout else last_d//2
+	if elapsed + next_check > last_d:
+		return True
+	if "{0:.1f}".format(percent) != last_percent:
+		return True
+	eta = time_left if time_left is not None else 7*24*3600
+	expected_eta = last_eta - elapsed
+	if abs(eta - expected_eta) > max(3600, expected_eta/10):
+		return True
+	debug_print("Progress of {0} is unchanged, no update needed".format(assignment_id))
+	return False
+
+def next_check_in(time_left):
+	"""Return the number of seconds until the next update, given the time left for the first assignment
+	It is half of the time left, so that the updates are rare while the assignment has days left and
+	get more frequent as the end approaches, between min_check_in and max_check_in.
+	It is --timeout when the end can't be estimated."""
+	if options.timeout <= 0:
+		# single update, the next one is not known
+		return 24*3600
+	if time_left is None:
+		return options.timeout
+	return int(min(max_check_in, max(min_check_in, time_left/2)))
+
+def map_in_flight(func, args_list):
+	"""Call func(*args) for each args of args_list, with at most options.max_in_flight
+	calls running at the same time, and return the results in the same order"""
+	if options.max_in_flight <= 1 or len(args_list) <= 1:
+		return [func(*args) for args in args_list]
+	from multiprocessing.pool import ThreadPool
+	# the spans of the pool threads are children of the span open in this thread
+	parent = tracer.current() if tracer is not None else None
+	def call(args):
+		if tracer is not None:
+			tracer.attach(parent)
+		# an exception which doesn't derive from Exception, like the SystemExit of
+		# parser.error, would end the worker without its result, and pool.map
+		# would wait for it forever: it is raised again in the main thread
+		try:
+			return True, func(*args)
+		except BaseException:
+			return False, sys.exc_info()[1]
+	pool = ThreadPool(min(options.max_in_flight, len(args_list)))
+	try:
+		results = pool.map(call, args_list)
+	finally:
+		pool.close()
+		pool.join()
+	for ok, result in results:
+		if not ok:
+			raise result
+	return [result for ok, result in results]
+
+def get_exponent(task, is_prp):
+	# Extract the subfield containing the exponent, whose position depends on the assignment type:
+	found = task.split(",")
+	idx = 3 if is_prp else 1
+	if len(found) <= idx:
+		return None
+	return int(found[idx])
+
 def get_progress_assignment(task):
 	found = workpattern.search(task)
 	if not found:
@@ -496,15 +1725,120 @@ def get_progress_assignment(task):
 	assignment_id = found.group(2)
 	is_prp = found.group(1) == "PRP"
 	debug_print("type = {0}, assignment_id = {1}".format(found.group(1), assignment_id))
-	found = task.split(",")
-	idx = 3 if is_prp else 1
-	if len(found) <= idx:
+	p = get_exponent(task, is_prp)
+	if p is None:
 		debug_print("Unable to extract valid exponent substring from entry in " + workfile + ": " + str(task))
 		return None, None
-	# Extract the subfield containing the exponent, whose position depends on the assignment type:
-	p = int(found[idx])
-	iteration, usec_per_iter = parse_stat_file(p)
-	return Assignment(assignment_id, p, is_prp, iteration, usec_per_iter)
+	statfile = stat_filename(p)
+	if statfile in stat_prefetched:
+		# already scanned by the worker pool for this cycle
+		iteration, usec_per_iter = stat_prefetched.pop(statfile)
+	else:
+		iteration, usec_per_iter = parse_stat_file(statfile, state)
+	return Assignment(assignment_id, p, is_prp, iteration, usec_per_iter, stat_fft_length(statfile))
+
+def prefetch_stat_files(workdirs):
+	"""Scan the p*.stat files of the assignments of all workdirs in a worker pool"""
+	statfiles = []
+	for wd in workdirs:
+		for task in greplike(workpattern, readonly_list_file(wd.workfile)):
+			found = workpattern.search(task)
+			p = get_exponent(task, found.group(1) == "PRP")
+			if p is not None:
+				statfiles.append((stat_filename(p, wd.dirname), wd.state))
+	if len(statfiles) < 2:
+		return
+	from multiprocessing.pool import ThreadPool # only needed in multi-workdir mode
+	pool = ThreadPool(min(len(statfiles), max_scan_threads))
+	try:
+		stat_prefetched.update(zip((statfile for statfile, _ in statfiles), pool.map(lambda args: parse_stat_file(*args), statfiles)))
+	finally:
+		pool.close()
+		pool.join()
+
+def read_speed_table(state):
+	"""Return the msec per iteration measured for each FFT length (in K), from the fft_speed section of the state"""
+	speed_table = {}
+	if state.has_section("fft_speed"):
+		for fft_length in state.options("fft_speed"):
+			try:
+				speed_table[int(fft_length)] = float(state.get("fft_speed", fft_length))
+			except ValueError:
+				pass
+	return speed_table
+
+def fft_cost(fft_length):
+	"""Relative cost of an iteration with an FFT of fft_length K floats: N log N"""
+	n = fft_length*1024
+	return n*log(n)
+
+def fft_max_bits(fft_length):
+	"""Approximate number of bits of the exponent which fit in each float of an FFT of fft_length K
+	(19.1 at 2048K, decreasing by 0.45 each time the length doubles)"""
+	return 19.1 - 0.45*log(fft_length/2048, 2)
+
+def fft_length_for(p):
+	"""Estimate the FFT length (in K) used to test p: the smallest length of the form k*2^m K,
+	8 <= k < 16, which is big enough for p"""
+	m = 0
+	while True:
+		for k in range(8, 16):
+			fft_length = k << m
+			if p <= fft_length*1024*fft_max_bits(fft_length):
+				return fft_length
+		m += 1
+
+def estimate_usec_per_iter(p, fft_length, speed_table):
+	"""Estimate the msec per iteration to test p with an FFT of fft_length K, None if nothing is measured yet
+	The measured speed is used if the FFT length is in the table, else the speed of the nearest
+	measured length is scaled by N log N. If unknown, the FFT length is estimated from p."""
+	if not speed_table:
+		return None
+	if fft_length is None:
+		fft_length = fft_length_for(p)
+	if fft_length in speed_table:
+		return speed_table[fft_length]
+	nearest = min(speed_table, key=lambda length: abs(log(length/fft_length)))
+	return speed_table[nearest]*fft_cost(fft_length)/fft_cost(nearest)
+
+# The throughput history fades out with this half-life, and longer pauses count as this maximum
+throughput_half_life = 7*24*3600
+throughput_max_pause = 3*24*3600
+# the throughput is not used before this amount of history
+throughput_min_history = 3600
+
+def update_throughput(p, dates, usec_per_iter):
+	"""Update the throughput of the test of p with the (date, iteration) of the last Iter lines
+	and return the fraction of the computing speed really achieved, None if not known yet
+	Only a summary is kept in the throughput section of the state (primenet.db): the date and iteration of
+	the last line taken into account, and the iterations done and the seconds elapsed since
+	the start of the test, both with an exponential decay."""
+	if not dates or usec_per_iter is None:
+		return None
+	try:
+		last_date, last_iteration, iterations, seconds = state.get("throughput", str(p)).split(",")
+		last_date, last_iteration, iterations, seconds = int(last_date), int(last_iteration), float(iterations), float(seconds)
+	except (ConfigParserError, ValueError):
+		# start from the oldest of the last lines
+		(last_date, last_iteration), iterations, seconds = dates[-1], 0.0, 0.0
+	date, iteration = dates[0]
+	elapsed = date - last_date
+	if elapsed > 0:
+		# after a restart from an older save file, the iterations done again are lost
+		done = max(iteration - last_iteration, 0)
+		# faster than the computation itself means that the clock has been changed,
+		# only the reference point is moved
+		if done/elapsed <= 1.5*1000/usec_per_iter:
+			elapsed = min(elapsed, throughput_max_pause)
+			decay = 0.5**(elapsed/throughput_half_life)
+			iterations = iterations*decay + done
+			seconds = seconds*decay + elapsed
+		if not state.has_section("throughput"):
+			state.add_section("throughput")
+		state.set("throughput", str(p), "{0},{1},{2:.0f},{3:.0f}".format(date, iteration, iterations, seconds))
+	if seconds < throughput_min_history:
+		return None
+	return min(1.0, iterations/seconds*usec_per_iter/1000)
 
 def compute_progress(p, iteration, usec_per_iter):
 	percent = 100*float(iteration)/float(p)
@@ -514,13 +1848,15 @@ def compute_progress(p, iteration, usec_per_iter):
 	time_left = int(usec_per_iter * iteration_left / 1000)
 	return percent, time_left
 
-def send_progress(assignment_id, is_prp, percent, time_left, retry_count=0):
+def send_progress(assignment_id, is_prp, percent, time_left):
+	"""Send the progress of an assignment
+	Return False if the update should be sent again later,
+	None if it should be sent again once the computer is registered again"""
 	guid = get_guid(config)
 	if guid is None:
 		debug_print("Cannot update, the registration is not done", file=sys.stderr)
 		debug_print("Call primenet.py with --register option", file=sys.stderr)
-		return
-	if retry_count > 5: return
+		return True
 	# Assignment Progress fields:
 	# g= the machine's GUID (32 chars, assigned by Primenet on 1st-contact from a given machine, stored in 'guid=' entry of local.ini file of rundir)
 	#
@@ -531,7 +1867,7 @@ def send_progress(assignment_id, is_prp, percent, time_left, retry_count=0):
 	# p= progress in %-done, 4-char format = xy.z
 	args["p"] = "{0:.1f}".format(percent)
 	# d= when the client is expected to check in again (in seconds ... )
-	args["d"] = options.timeout if options.timeout else 24*3600
+	args["d"] = next_update.get(workdir, options.timeout) if options.timeout else 24*3600
 	# e= the ETA of completion in seconds, if unknown, just put 1 week
 	args["e"] = time_left if time_left is not None else 7*24*3600
 	# c= the worker thread of the machine ... always sets = 0 for now, elaborate later if desired
@@ -539,28 +1875,30 @@ def send_progress(assignment_id, is_prp, percent, time_left, retry_count=0):
 	# stage= LL in this case, although an LL test may be doing TF or P-1 work first so it's possible to be something besides LL
 	if not is_prp:
 		args["stage"] = "LL"
-	retry = False
-	result = send_request(guid, args)
-	if result is None:
-		debug_print("ERROR while updating on mersenne.org", file=sys.stderr)
-		# Try again
-		retry = True
+	with span("send_progress", assignment=assignment_id, percent=args["p"]):
+		result = send_request(guid, args)
+	if result is None or int(result["pnErrorResult"]) == primenet_api.ERROR_SERVER_BUSY:
+		# send_request has already retried, it is kept in the outbox for the next cycle
+		debug_print("ERROR while updating on mersenne.org, the update is deferred", file=sys.stderr)
+		return False
 	else:
 		rc = int(result["pnErrorResult"])
 		if rc == primenet_api.ERROR_OK:
 			debug_print("Update correctly send to server")
+			# remember what was sent, to send the next update only when it is needed
+			if not state.has_section("progress"):
+				state.add_section("progress")
+			state.set("progress", assignment_id, "{0},{1},{2},{3}".format(args["p"], args["e"], int(now()), args["d"]))
 		elif rc == primenet_api.ERROR_STALE_CPU_INFO:
 			debug_print("STALE CPU INFO ERROR: re-send computer update")
 			# rerun --register
-			register_instance(guid)
-			retry = True
+			reregister_later(guid, guid)
+			return None
 		elif rc == primenet_api.ERROR_UNREGISTERED_CPU:
 			debug_print("UNREGISTERED CPU ERROR: pick a new GUID and register again")
 			# corrupted GUI: change GUID, and rerun --register
-			register_instance(None)
-			retry = True
-		elif rc == primenet_api.ERROR_SERVER_BUSY:
-			retry = True
+			reregister_later(guid, None)
+			return None
 		else:
 			# TODO: treat more errors correctly in all send_request callers
 			# primenet_api.ERROR_INVALID_ASSIGNMENT_KEY
@@ -569,9 +1907,7 @@ def send_progress(assignment_id, is_prp, percent, time_left, retry_count=0):
 			debug_print("ERROR while updating on mersenne.org", file=sys.stderr)
 			debug_print("Code: "+str(rc), file=sys.stderr)
 			debug_print("Reason: "+result["pnErrorDetail"], file=sys.stderr)
-	if retry:
-		return send_progress(assignment_id, is_prp, percent, time_left, retry_count+1)
-	return
+	return True
 
 def submit_one_line(sendline):
 	"""Submit one line"""
@@ -649,6 +1985,9 @@ def submit_one_line_v5(sendline, guid, ar):
 		# if this happens, the submission can be retried
 		# since no answer has been received from the server
 		return False
+	elif int(result["pnErrorResult"]) == primenet_api.ERROR_SERVER_BUSY:
+		debug_print("Server busy, the result will be submitted again at the next cycle: assignment_id={0}".format(aid), file=sys.stderr)
+		return False
 	elif int(result["pnErrorResult"]) == primenet_api.ERROR_OK:
 		debug_print("Result correctly send to server: assignment_id={0}".format(aid))
 		if result["pnErrorDetail"] != "SUCCESS":
@@ -672,45 +2011,193 @@ def submit_one_line_v5(sendline, guid, ar):
 def submit_one_line_manually(sendline):
 	"""Submit results using manual testing, will be attributed to "Manual Testing" in mersenne.org"""
 	debug_print("Submitting using manual results\n" + sendline)
-	try:
-		post_data = urlencode({"data": sendline}).encode('utf-8')
-		r = primenet.open(primenet_baseurl + "manual_result/default.php", post_data)
-		res = r.read()
-		if b"Error" in res:
-			res_str = res.decode("utf-8", "replace")
-			ibeg = res_str.find("Error")
-			iend = res_str.find("</div>", ibeg)
-			print("Submission failed: '{0}'".format(res_str[ibeg:iend]))
-		elif b"Accepted" in res:
-			pass
-		else:
-			print("submit_work: Submission of results line '" + sendline + "' failed for reasons unknown - please try manual resubmission.")
-	except URLError:
+	open_network()
+	post_data = urlencode({"data": sendline}).encode('utf-8')
+	res = primenet_open(primenet_baseurl + "manual_result/default.php", post_data)
+	if res is None:
 		debug_print("URL open ERROR")
+	elif b"Error" in res:
+		res_str = res.decode("utf-8", "replace")
+		ibeg = res_str.find("Error")
+		iend = res_str.find("</div>", ibeg)
+		print("Submission failed: '{0}'".format(res_str[ibeg:iend]))
+	elif b"Accepted" in res:
+		pass
+	else:
+		print("submit_work: Submission of results line '" + sendline + "' failed for reasons unknown - please try manual resubmission.")
 	return True	# EWM: Append entire results_send rather than just sent to avoid resubmitting
 				# bad results (e.g. previously-submitted duplicates) every time the script executes.
 
-def submit_work():
-	results_send = read_list_file(sentfile)
-	# Only submit completed work, i.e. the exponent must not exist in worktodo file any more
-	results = readonly_list_file(resultsfile) # appended line by line, no lock needed
-	# EWM: Note that read_list_file does not need the file(s) to exist - nonexistent files simply yield 0-length rs-array entries.
-	results = filter(mersenne_find, results)	# remove nonsubmittable lines from list of possibles
-
-	results_send = [line for line in results if line not in results_send]	# if a line was previously submitted, discard
+def result_digest(line):
+	"""Digest of a result line, used as its key in the results_sent index"""
+	return sha256(line.strip().encode("utf-8")).hexdigest()
+
+def compact_sent():
+	"""Archive results_sent.txt and keep in the index only the results still in results.txt"""
+	# without SQLite, the index is built from results_sent.txt before it is archived
+	state.sent_index()
+	results_digests = set(result_digest(line) for line in readonly_list_file(resultsfile))
+	if os.path.exists(sentfile):
+		n = 1
+		while os.path.exists("{0}.{1}".format(sentfile, n)):
+			n += 1
+		archive = "{0}.{1}".format(sentfile, n)
+		os.rename(sentfile, archive)
+		debug_print("{0} archived to {1}".format(sentfile, archive))
+	kept, removed = state.keep_sent(results_digests)
+	debug_print("{0} digests of sent results kept, {1} removed".format(kept, removed))
+
+def file_fingerprint(File, offset):
+	"""Fingerprint of the bytes before offset, to check the file is the same as when offset was saved"""
+	start = max(0, offset - 256)
+	File.seek(start)
+	return sha256(File.read(offset - start)).hexdigest()[:16]
+
+def read_new_results():
+	"""Return the complete lines appended to results.txt since the last call,
+	as a list of (offset of the line, line), and the offset after the last line.
+	The offset is saved in local.ini. If results.txt has been truncated or
+	replaced by an other file, it is read again from the beginning."""
+	try:
+		File = open(resultsfile, "rb") # appended line by line, no lock needed
+	except (IOError,OSError):
+		return [], 0
+	with File:
+		offset = 0
+		if state.has_option("primenet", "results_offset"):
+			offset = int(state.get("primenet", "results_offset"))
+			File.seek(0, os.SEEK_END)
+			if offset > File.tell() or file_fingerprint(File, offset) != state.get("primenet", "results_fingerprint"):
+				debug_print("{0} has been truncated or replaced, reading it from the beginning".format(resultsfile))
+				offset = 0
+		File.seek(offset)
+		data = File.read()
+	# an incomplete last line will be read at the next call
+	data = data[:data.rfind(b"\n")+1]
+	lines = []
+	for line in data.split(b"\n")[:-1]:
+		lines.append((offset, line.decode("utf-8", "replace").rstrip()))
+		offset += len(line) + 1
+	return lines, offset
+
+def save_results_offset(offset):
+	"""Save the offset in results.txt from where the next results will be read"""
+	if state.has_option("primenet", "results_offset") and int(state.get("primenet", "results_offset")) == offset:
+		return
+	with open(resultsfile, "rb") as File:
+		fingerprint = file_fingerprint(File, offset)
+	state.set("primenet", "results_offset", str(offset))
+	state.set("primenet", "results_fingerprint", fingerprint)
+	state.commit()
+
+outbox_lock = Lock()
+def outbox_append(records):
+	"""Append records to the outbox journal, and make sure they are on disk
+	Each pending operation has a key, a result digest or an assignment ID, so that
+	a record for the same key replaces the previous one, and a record with "done"
+	removes it. A crash can't lose an operation. The operations are done at least
+	once: the one which was in flight during a crash is done again, except a result
+	already recorded as sent, which is found by its digest."""
+	if not records:
+		return
+	with outbox_lock:
+		with open(outboxfile, "a") as File:
+			for record in records:
+				File.write(json.dumps(record, sort_keys=True) + "\n")
+			File.flush()
+			os.fsync(File.fileno())
+
+def read_outbox():
+	"""Return the pending operations of the outbox journal, key -> record, in journal order"""
+	pending = OrderedDict()
+	for line in readonly_list_file(outboxfile):
+		try:
+			record = json.loads(line)
+		except ValueError:
+			# incomplete last line, written when the process was killed
+			continue
+		if record.get("done"):
+			pending.pop(record["key"], None)
+		else:
+			pending[record["key"]] = record
+	return pending
+
+def flush_one(record, sent_digests):
+	"""Do the operation of an outbox record, return True if it is done,
+	None if it has to be done again once the computer is registered again
+	Once done, it is removed from the journal right away by a "done" record, so
+	that a crash before flush_outbox() rewrites the journal doesn't do it again."""
+	done = do_operation(record, sent_digests)
+	if done:
+		outbox_append([{"key": record["key"], "done": True}])
+	return done
+
+def do_operation(record, sent_digests):
+	if not retry_scheduler.allow():
+		return False
+	if record["t"] == "ar":
+		sendline = record["line"]
+		if result_digest(sendline) in sent_digests:
+			# sent before the process was killed, only the "done" record is missing
+			return True
+		if not submit_one_line(sendline):
+			return False
+		with outbox_lock:
+			write_list_file(sentfile, [sendline], "a")
+			state.add_sent([result_digest(sendline)])
+		return True
+	elif record["t"] == "ap":
+		return send_progress(*record["args"])
+	debug_print("Unknown operation in {0}: {1}".format(outboxfile, record), file=sys.stderr)
+	return True
 
-	# Only for new results, to be appended to results_sent
-	sent = []
+def flush_outbox():
+	"""Do the pending operations of the outbox, as long as the server accepts them"""
+	pending = read_outbox()
+	records = list(pending.values())
+	sent_digests = state.sent_index() if any(record["t"] == "ar" for record in records) else set()
+	for retry_count in range(6):
+		done = map_in_flight(flush_one, [(record, sent_digests) for record in records])
+		for record, is_done in zip(records, done):
+			if is_done:
+				del pending[record["key"]]
+		# the operations refused because of the registration are done again once registered
+		records = [record for record, is_done in zip(records, done) if is_done is None]
+		if not reregister_instances() or not records:
+			break
+	for t in ("ar", "ap"):
+		metrics.set("primenet_outbox_pending", {"workdir": workdir, "type": t}, sum(1 for record in pending.values() if record["t"] == t))
+	if not pending:
+		if os.path.exists(outboxfile):
+			os.remove(outboxfile)
+		return
+	# keep only the pending operations, replacing the journal atomically
+	with outbox_lock:
+		with replace_file(outboxfile) as File:
+			for record in pending.values():
+				File.write(json.dumps(record, sort_keys=True) + "\n")
+	debug_print("{0} operations still pending in {1}".format(len(pending), outboxfile))
 
-	if len(results_send) == 0:
+def submit_work():
+	# Only the lines appended to results.txt since the last call are read,
+	# and each of them is filtered by its digest in the index of the results already sent
+	# and by the keys of the operations pending in the outbox
+	with span("read_new_results", file=os.path.basename(resultsfile)) as scan:
+		lines, end = read_new_results()
+		scan.set(lines=len(lines))
+	if lines:
+		sent_digests = state.sent_index()
+		pending = read_outbox()
+		# remove nonsubmittable lines from list of possibles and
+		# if a line was previously submitted, discard
+		results_send = [line for offset, line in lines if mersenne_find(line) and result_digest(line) not in sent_digests]
+		outbox_append([{"key": "ar:" + result_digest(line), "t": "ar", "line": line} for line in results_send if "ar:" + result_digest(line) not in pending])
+		# once in the outbox, the results don't need to be read again
+		save_results_offset(end)
+	if not lines or not results_send:
 		debug_print("No complete results found to send.")
-		return
-	# EWM: Switch to one-result-line-at-a-time submission to support error-message-on-submit handling:
-	for sendline in results_send:
-		is_sent = submit_one_line(sendline)
-		if is_sent:
-			sent.append(sendline)
-	write_list_file(sentfile, sent, "a")
+	# EWM: Switch to one-result-line-at-a-time submission to support error-message-on-submit handling
+	flush_outbox()
 
 #######################################################################################################
 #
@@ -718,6 +2205,14 @@ def submit_work():
 #
 #######################################################################################################
 
+def default_hostname():
+	try:
+		return os.uname()[1][:20]
+	except AttributeError:
+		# Windows, platform is only imported there
+		import platform
+		return platform.node()[:20]
+
 parser = OptionParser(version="primenet.py 19.1", description=\
 """This program is used to fill worktodo.ini with assignments and send the results for Mlucas
 program. It also saves its configuration to local.ini file, so it is necessary to gives the arguments only the first time you call it. Arguments are recovered for local.ini if not given.
@@ -728,7 +2223,8 @@ Then, without --register, it fetches assignment and send results to mersenne.org
 
 # options not saved to local.ini
 parser.add_option("-d", "--debug", action="count", dest="debug", default=False, help="Display debugging info")
-parser.add_option("-w", "--workdir", dest="workdir", default=".", help="Working directory with worktodo.ini and results.txt from mlucas, and local.ini created by this program. Default current directory")
+parser.add_option("-w", "--workdir", dest="workdir", action="append", help="Working directory with worktodo.ini and results.txt from mlucas, and local.ini created by this program. Default current directory. Can be given several times, and may be a glob pattern, to handle several Mlucas instances from one process.")
+parser.add_option("--compact_sent", action="store_true", dest="compact_sent", default=False, help="Archive results_sent.txt to results_sent.txt.N and remove from results_sent.idx the results which are not in results.txt any more, then exit.")
 
 # all other options are saved to local.ini (except --register)
 parser.add_option("-u", "--username", dest="username", help="Primenet user name")
@@ -740,11 +2236,23 @@ parser.add_option("-T", "--worktype", dest="worktype", default="101", help="Work
 parser.add_option("-n", "--num_cache", dest="num_cache", type="int", default=1, help="Number of assignments to cache, default: %default")
 parser.add_option("-L", "--percent_limit", dest="percent_limit", type="int", default=90, help="Add one to num_cache when current assignment is already done at this percentage, default: %default")
 
-parser.add_option("-t", "--timeout", dest="timeout", type="int", default=60*60*6, help="Seconds to wait between network updates, default %default [6 hours]. Use 0 for a single update without looping.")
+parser.add_option("-t", "--timeout", dest="timeout", type="int", default=60*60*6, help="Seconds to wait between network updates when the end of the first assignment can't be estimated, default %default [6 hours]. Otherwise the wait is half of its time left, up to a week, so that the updates get more frequent as it nears its end. Use 0 for a single update without looping.")
+parser.add_option("--watch", action="store_true", dest="watch", default=False, help="Between the updates, watch results.txt and worktodo.ini and send the new results and get new assignments as soon as Mlucas changes them. The progress is still sent at the planned updates.")
+parser.add_option("--max_in_flight", dest="max_in_flight", type="int", default=1, help="Maximum number of progress updates or results sent to the server at the same time, default: %default")
+parser.add_option("--metrics", dest="metrics", help="Write the metrics of each cycle (durations, requests, progress of the assignments...) to this file in the Prometheus text format, e.g. for the textfile collector of node_exporter")
+parser.add_option("--metrics_listen", dest="metrics_listen", help="In daemon mode, serve the metrics in the Prometheus text format on [address:]port, the address is 127.0.0.1 by default")
+parser.add_option("--profile", dest="profile", help="Profile each cycle with cProfile and save it to this file in the pstats format, the previous cycles are kept as PROFILE.1, PROFILE.2... In daemon mode, the signal SIGUSR1 prints the profile of the last cycle. Only the main thread is profiled: with --max_in_flight > 1, the requests sent by the other threads are missing from the profile")
+parser.add_option("--profile_keep", dest="profile_keep", type="int", default=10, help="Number of cycles whose profile is kept, default %default")
+parser.add_option("--trace", dest="trace", help="Append the spans of the operations of each cycle (requests, file scans...) with their durations and attributes to this file, to view how the time is spent")
+parser.add_option("--trace_format", dest="trace_format", type="choice", choices=("chrome", "otlp"), default="chrome", help="Format of the --trace file: chrome for the Chrome trace events (chrome://tracing, Perfetto) or otlp for OpenTelemetry OTLP-JSON lines, default %default")
+parser.add_option("--tracemalloc", dest="tracemalloc", type="int", default=0, help="With --profile, print the N lines which allocated the most memory since the start after each cycle and on SIGUSR1 (Python 3.4+)")
+# Not shown in the help: the URLs of a local stand-in of the server for the load tests (tests/primenet_server.py)
+parser.add_option("--v5_url", dest="v5_url", default=primenet_v5_burl, help=SUPPRESS_HELP)
+parser.add_option("--www_url", dest="www_url", default=primenet_baseurl, help=SUPPRESS_HELP)
 
 group = OptionGroup(parser, "Registering Options: send to mersenne.org when registering, visible in CPUs in the website.")
 group.add_option("-r", "--register", action="store_true", dest="register", default=False, help="Register to mersenne.org, this allows sending regular updates and follow the progress on the website.")
-group.add_option("-H", "--hostname", dest="hostname", default=platform.node()[:20], help="Hostname name for mersenne.org, default: %default")
+group.add_option("-H", "--hostname", dest="hostname", default=default_hostname(), help="Hostname name for mersenne.org, default: %default")
 # TODO: add detection for most parameter, including automatic change of the hardware
 group.add_option("-c", "--cpu_model", dest="cpu_model", default="cpu.unknown", help="CPU model, defautl: %default")
 group.add_option("--features", dest="features", default="", help="CPU features, default '%default'")
@@ -756,18 +2264,6 @@ group.add_option("--np", dest="np", type="int", default=1, help="number of proce
 group.add_option("--hp", dest="hp", type="int", default=0, help="number of hyperthreading cores (0 is unknown), default: %default")
 parser.add_option_group(group)
 
-(options, args) = parser.parse_args()
-
-progname = os.path.basename(sys.argv[0])
-workdir = os.path.expanduser(options.workdir)
-
-localfile = os.path.join(workdir, "local.ini")
-workfile = os.path.join(workdir, "worktodo.ini")
-resultsfile = os.path.join(workdir, "results.txt")
-
-# A cumulative backup
-sentfile = os.path.join(workdir, "results_sent.txt")
-
 # Good refs re. Python regexp: https://www.geeksforgeeks.org/pattern-matching-python-regex/, https://www.python-course.eu/re.php
 # pre-v19 only handled LL-test assignments starting with either DoubleCheck or Test, followed by =, and ending with 3 ,number pairs:
 #
@@ -817,103 +2313,489 @@ workpattern = re.compile("(DoubleCheck|Test|PRP)\s*=\s*([0-9A-F]{32})(,[0-9]+){3
 # mersenne.org limit is about 4 KB; stay on the safe side
 sendlimit = 3000 # TODO: enforce this limit
 
-# adapted from http://stackoverflow.com/questions/923296/keeping-a-session-in-python-while-making-http-requests
-primenet_cj = cookiejar.CookieJar()
-primenet = build_opener(HTTPCookieProcessor(primenet_cj))
+primenet_cj = None # cookie jar of the session, created by import_network()
+primenet = None # opener built by install_openers()
+# primenet_cookies.txt, loaded by open_network() before the first request
+cookies_file = None
+cookies_loaded = False
+connection_pool = ConnectionPool()
+retry_scheduler = RetryScheduler()
+metrics = Metrics()
+profiler = None # Profiler of the cycles, with --profile
+tracer = None # Tracer of the operations, with --trace
+backoff_sleep = sleep # no wait when testing
+
+# current date, fixed when testing
+now = time
+# when testing, the content of primenet.db is written to primenet.db.sql at each commit
+dump_state = False
+
+# The current workdir, selected by select_workdir()
+options = None
+config = None
+state = None # StateStore, or IniState without SQLite
+workdir = localfile = workfile = resultsfile = sentfile = sentindexfile = statefile = outboxfile = None
+# prefix of debug_print messages, only set when several workdirs are handled
+workdir_tag = ""
+progname = os.path.basename(sys.argv[0])
 
-# If debug is requested, try importinh urllib_debug.
-# Disabled debug if import is failing. This allows not distribuing urllib_debug module
-# when it is not useful.
-if options.debug > 1:
-	# if urllib_debug is not present, don't try to activate the debugging
+# seconds until the next update of each workdir, planned by update_progress()
+next_update = {}
+min_check_in = 10*60
+# the longest interval between the check-ins of Prime95 (DaysBetweenCheckins)
+max_check_in = 7*24*3600
+
+# p*.stat files scanned in advance by prefetch_stat_files() for the current cycle
+stat_prefetched = {}
+max_scan_threads = 8
+
+class Workdir(object):
+	"""State kept in memory for each Mlucas working directory handled by this process"""
+	def __init__(self, dirname, options):
+		self.dirname = os.path.expanduser(dirname)
+		# each workdir has its own local.ini, so its own copy of the options
+		self.options = copy(options)
+		self.localfile = os.path.join(self.dirname, "local.ini")
+		self.workfile = os.path.join(self.dirname, "worktodo.ini")
+		self.resultsfile = os.path.join(self.dirname, "results.txt")
+		# A cumulative backup
+		self.sentfile = os.path.join(self.dirname, "results_sent.txt")
+		# digests of the lines of sentfile, to find quickly the results already sent
+		self.sentindexfile = os.path.join(self.dirname, "results_sent.idx")
+		self.config = None
+		# state kept between the runs, with the digests of the results sent
+		self.statefile = os.path.join(self.dirname, "primenet.db")
+		self.state = None
+		# journal of the results and progress updates not sent yet
+		self.outboxfile = os.path.join(self.dirname, "outbox.jsonl")
+		# held by the process which handles the workdir
+		self.lockfile = os.path.join(self.dirname, "primenet.lock")
+		self.lock = None
+
+def select_workdir(wd):
+	"""Make wd the current workdir for all the functions working on files or config"""
+	global workdir, options, config, state, localfile, workfile, resultsfile, sentfile, sentindexfile, statefile, outboxfile
+	workdir = wd.dirname
+	options = wd.options
+	config = wd.config
+	state = wd.state
+	localfile = wd.localfile
+	workfile = wd.workfile
+	resultsfile = wd.resultsfile
+	sentfile = wd.sentfile
+	sentindexfile = wd.sentindexfile
+	statefile = wd.statefile
+	outboxfile = wd.outboxfile
+
+def lock_workdir(wd):
+	"""Take the run lock of the workdir, held until the process exits, so that a run
+	started (by cron) while the previous one is still running skips the workdir
+	instead of fetching or sending the same work. Return False if it is held."""
 	try:
-		import urllib_debug
-	except ImportError:
-		options.debug = 1
-
-if options.debug == 3:
-	debug_print("Enable testing url request and responses")
-	from urllib_debug import TestHTTPHandler, TestHTTPSHandler
-	primenet = build_opener(HTTPCookieProcessor(primenet_cj), TestHTTPHandler, TestHTTPSHandler)
-	my_opener = build_opener(TestHTTPHandler, TestHTTPSHandler)
-	install_opener(my_opener)
-	from random import seed
-	seed(3)
-elif options.debug == 2:
-	debug_print("Enable spying url request and responses")
-	from urllib_debug import SpyHTTPHandler, SpyHTTPSHandler
-	primenet = build_opener(HTTPCookieProcessor(primenet_cj), SpyHTTPHandler, SpyHTTPSHandler)
-	my_opener = build_opener(SpyHTTPHandler, SpyHTTPSHandler)
-	install_opener(my_opener)
-
-# load local.ini and update options
-config = config_read()
-config_updated = merge_config_and_options(config, options)
-
-# check options after merging so that if local.ini file is changed by hand,
-# values are also checked
-# TODO: check that input char are ascii or at least supported by the server
-if not (8 <= len(options.cpu_model) <= 64):
-	parser.error("cpu_model must be between 8 and 64 characters")
-if options.hostname is not None and len(options.hostname) > 20:
-	parser.error("hostname must be less than 21 characters")
-if options.features is not None and len(options.features) > 64:
-	parser.error("features must be less than 64 characters")
-
-# write back local.ini if necessary
-if config_updated:
-	debug_print("write local.ini")
-	config_write(config)
-
-if options.register:
-	# if guid already exist, recover it, this way, one can (re)register to change
-	# the CPU model (changing instance name can only be done in the website)
-	guid = get_guid(config)
-	register_instance(guid)
-	sys.exit(0)
-
-if options.username is None or options.password is None:
-	parser.error("Username and password must be given")
-
-while True:
-	# Log in to primenet
+		wd.lock = open(wd.lockfile, "a")
+	except (IOError, OSError):
+		# read-only or missing directory, the errors are reported as before
+		return True
+	if lock_file(wd.lock, blocking=False):
+		return True
+	wd.lock.close()
+	wd.lock = None
+	return False
+
+def expand_workdirs(patterns):
+	if not patterns:
+		return ["."]
+	workdirs = []
+	for pattern in patterns:
+		pattern = os.path.expanduser(pattern)
+		matches = sorted(d for d in glob(pattern) if os.path.isdir(d))
+		if not matches:
+			if re.search("[*?[]", pattern):
+				parser.error("No working directory matches " + pattern)
+			matches = [pattern]
+		workdirs.extend(d for d in matches if d not in workdirs)
+	return workdirs
+
+def load_workdir(wd):
+	"""Load local.ini and the state of the workdir and update its options"""
+	select_workdir(wd)
+	wd.config = config_read()
+	select_workdir(wd)
+	wd.state = open_state()
+	select_workdir(wd)
+	config_updated = merge_config_and_options(config, options)
+
+	# check options after merging so that if local.ini file is changed by hand,
+	# values are also checked
+	# TODO: check that input char are ascii or at least supported by the server
+	if not (8 <= len(options.cpu_model) <= 64):
+		parser.error("cpu_model must be between 8 and 64 characters")
+	if options.hostname is not None and len(options.hostname) > 20:
+		parser.error("hostname must be less than 21 characters")
+	if options.features is not None and len(options.features) > 64:
+		parser.error("features must be less than 64 characters")
+
+	# write back local.ini if necessary
+	if config_updated:
+		debug_print("write local.ini")
+		config_write(config)
+
+def primenet_do_login(username, password):
+	"""Log in to www.mersenne.org, the session is shared by all workdirs"""
+	global primenet_login
 	try:
 		login_data = OrderedDict((
-			("user_login", options.username),
-			("user_password", options.password),
+			("user_login", username),
+			("user_password", password),
 		))
 
-		# TODO: login only if necessary:
-		# TODO: when configuration has been changed to test the password
-		# TODO: when getting assignments is necessary
-		# TODO: on a monthly basis ?
 		# This makes a POST instead of GET
 		data = urlencode(login_data).encode('utf-8')
-		r = primenet.open(primenet_baseurl + "default.php", data)
-		if not (options.username + "<br>logged in").encode('utf-8') in r.read():
+		if not primenet_logged_in(www_open(primenet_baseurl + "default.php", data)):
 			primenet_login = False
 			debug_print("ERROR: Login failed.")
 		else:
 			primenet_login = True
+			save_cookies()
 	except URLError:
 		debug_print("Primenet URL open ERROR")
+	return primenet_login
 
-	if primenet_login:
-		submit_work()
-		progress = update_progress()
-		got = get_assignment(progress)
-		if got > 0:
-			debug_print("Redo progress update to update the just obtained assignment")
-			# Since assignment are obtain by manual assignment, it is important to update them
-			# to mark them as belonging to the current computer.
-			update_progress()
-	if options.timeout <= 0:
-		break
+def www_open(url, data=None):
+	"""Return the content of a page of www.mersenne.org, opened with the session"""
+	open_network()
+	start = now()
+	res = b""
 	try:
-		sleep(options.timeout)
-	except KeyboardInterrupt:
-		break
+		res = primenet.open(url, data).read()
+		return res
+	finally:
+		endpoint = url[len(primenet_baseurl):].partition("?")[0].strip("/")
+		metrics.request(endpoint, now() - start, len(url) + len(data or b""), len(res))
+
+def primenet_logged_in(page):
+	"""Each page of www.mersenne.org shows the user name when the session is valid"""
+	return (options.username + "<br>logged in").encode('utf-8') in page
+
+login_lock = Lock()
+def primenet_open(url, data=None):
+	"""Open a page of www.mersenne.org which needs the session, logging in
+	only if there is no session yet or if the saved one is stale.
+	Return the content of the page or None in case of error"""
+	global primenet_login
+	open_network()
+	for retry in range(2):
+		with login_lock:
+			if not primenet_login and not measure_phase("login", primenet_do_login, options.username, options.password):
+				return None
+		try:
+			res = www_open(url, data)
+		except URLError:
+			return None
+		if primenet_logged_in(res):
+			save_cookies()
+			return res
+		with login_lock:
+			if primenet_login:
+				debug_print("Session cookie is stale, login again")
+				primenet_login = False
+	return None
+
+def load_cookies(filename):
+	"""Restore the www.mersenne.org session saved by a previous run"""
+	global primenet_login
+	primenet_cj.filename = filename
+	try:
+		primenet_cj.load(ignore_discard=True)
+	except (IOError, OSError, cookiejar.LoadError):
+		return
+	# the session is assumed valid until a page shows otherwise
+	primenet_login = len(primenet_cj) > 0
+
+def save_cookies():
+	try:
+		primenet_cj.save(ignore_discard=True)
+		os.chmod(primenet_cj.filename, 0o600)
+	except (IOError, OSError) as e:
+		debug_print("ERROR saving {0}: {1}".format(primenet_cj.filename, e), file=sys.stderr)
+
+class FileWatcher(object):
+	"""Wait for a change of results.txt or worktodo.ini in a set of directories
+	inotify is used on Linux, elsewhere the size and date of the files are checked every poll_interval seconds"""
+	names = ("results.txt", "worktodo.ini")
+	# IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	inotify_mask = 0x002 | 0x008 | 0x080 | 0x100 | 0x200
+	event_header = struct.Struct("iIII") # wd, mask, cookie, len, followed by the name
+
+	def __init__(self, dirnames, poll_interval=10, settle_delay=1):
+		self.dirnames = dirnames
+		self.poll_interval = poll_interval
+		# Mlucas may write a file in several steps, wait for the end before reading it
+		self.settle_delay = settle_delay
+		self.fd = None
+		self.watches = {}
+		try:
+			self.init_inotify()
+		except (ImportError, AttributeError, OSError) as e:
+			debug_print("inotify not available ({0}), checking the files every {1} seconds".format(e, poll_interval))
+		self.snapshot = self.stat_files()
+
+	def init_inotify(self):
+		import ctypes
+		import ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		fd = libc.inotify_init()
+		if fd < 0:
+			raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+		# the directories are watched, so that the files can be created or replaced
+		for dirname in self.dirnames:
+			path = dirname if isinstance(dirname, bytes) else dirname.encode(sys.getfilesystemencoding() or "utf-8")
+			wd = libc.inotify_add_watch(fd, path, self.inotify_mask)
+			if wd < 0:
+				errno = ctypes.get_errno()
+				os.close(fd)
+				raise OSError(errno, "{0}: {1}".format(dirname, os.strerror(errno)))
+			self.watches[wd] = dirname
+		self.fd = fd
+
+	def stat_files(self):
+		snapshot = {}
+		for dirname in self.dirnames:
+			for name in self.names:
+				try:
+					st = os.stat(os.path.join(dirname, name))
+					snapshot[(dirname, name)] = (st.st_ino, st.st_size, st.st_mtime)
+				except OSError:
+					snapshot[(dirname, name)] = None
+		return snapshot
+
+	def read_events(self, timeout):
+		"""Return the directories where a watched file changed, waiting at most timeout seconds"""
+		deadline = time() + timeout
+		changed = set()
+		while not changed:
+			try:
+				ready = select.select([self.fd], [], [], max(deadline - time(), 0))[0]
+			except select.error as e:
+				# interrupted by a signal (SIGUSR1), only with Python < 3.5
+				if e.args[0] == EINTR:
+					continue
+				raise
+			if not ready:
+				break
+			buf = os.read(self.fd, 64*1024)
+			offset = 0
+			while offset + self.event_header.size <= len(buf):
+				wd, mask, cookie, length = self.event_header.unpack_from(buf, offset)
+				offset += self.event_header.size
+				name = buf[offset:offset+length].rstrip(b"\0").decode("utf-8", "replace")
+				offset += length
+				# the events of the other files (p*.stat, local.ini...) are ignored
+				if name in self.names and wd in self.watches:
+					changed.add(self.watches[wd])
+		return changed
+
+	def poll(self, timeout):
+		"""Return the directories where a watched file changed since the last call,
+		checking them every poll_interval seconds during at most timeout seconds"""
+		deadline = time() + timeout
+		while True:
+			snapshot = self.stat_files()
+			changed = set(key[0] for key, st in snapshot.items() if self.snapshot.get(key) != st)
+			self.snapshot = snapshot
+			remaining = deadline - time()
+			if changed or remaining <= 0:
+				return changed
+			sleep(min(self.poll_interval, remaining))
+
+	def wait(self, timeout):
+		"""Wait at most timeout seconds, return the directories where a watched file changed"""
+		changes = self.read_events if self.fd is not None else self.poll
+		changed = changes(timeout)
+		if changed:
+			# the changes made until the end of the writes are reported with the first one
+			sleep(self.settle_delay)
+			changed |= changes(0)
+		return changed
+
+def watch_workdirs(watcher, workdirs, timeout):
+	"""During timeout seconds, send the results and get the assignments of a workdir as soon as
+	Mlucas appends to results.txt or consumes worktodo.ini"""
+	global workdir_tag
+	deadline = time() + timeout
+	while True:
+		remaining = deadline - time()
+		if remaining <= 0:
+			return
+		changed = watcher.wait(remaining)
+		for wd in workdirs:
+			if wd.dirname not in changed:
+				continue
+			select_workdir(wd)
+			if len(workdirs) > 1:
+				workdir_tag = wd.dirname + ": "
+			debug_print("results.txt or worktodo.ini changed")
+			measure_phase("submit", submit_work)
+			# The progress is only sent by the periodic updates
+			measure_phase("fetch", get_assignment, None)
+		workdir_tag = ""
+		if changed and tracer is not None:
+			tracer.flush()
+		if changed and options.metrics:
+			write_metrics(options.metrics)
+
+def update_workdirs(workdirs):
+	"""One cycle: send the results and the progress, and get the assignments of each workdir"""
+	global workdir_tag
+	if len(workdirs) > 1:
+		prefetch_stat_files(workdirs)
+	for wd in workdirs:
+		select_workdir(wd)
+		if len(workdirs) > 1:
+			workdir_tag = wd.dirname + ": "
+		metrics.set("primenet_phase_duration_seconds", {"workdir": workdir, "phase": "login"}, 0)
+		measure_phase("submit", submit_work)
+		progress = measure_phase("progress", update_progress)
+		# the assignments from the v5 API already belong to this computer,
+		# their progress is sent by the next update
+		measure_phase("fetch", get_assignment, progress)
+	workdir_tag = ""
+	stat_prefetched.clear()
+
+def sleep_until(deadline):
+	"""Sleep until deadline, Python < 3.5 ends the sleep early when a signal (SIGUSR1) is handled"""
+	while True:
+		remaining = deadline - time()
+		if remaining <= 0:
+			return
+		sleep(remaining)
+
+def main():
+	global options, progname, workdir_tag, primenet, now, backoff_sleep, dump_state, primenet_v5_burl, primenet_baseurl, profiler, tracer, cookies_file
+	(options, args) = parser.parse_args()
+	progname = os.path.basename(sys.argv[0])
+	primenet_v5_burl = options.v5_url
+	primenet_baseurl = options.www_url
+
+	# If debug is requested, try importinh urllib_debug.
+	# Disabled debug if import is failing. This allows not distribuing urllib_debug module
+	# when it is not useful.
+	if options.debug > 1:
+		# if urllib_debug is not present, don't try to activate the debugging
+		try:
+			import urllib_debug
+		except ImportError:
+			options.debug = 1
+
+	if options.debug == 3:
+		debug_print("Enable testing url request and responses")
+		from urllib_debug import TestHTTPHandler, TestHTTPSHandler
+		import_network()
+		primenet = build_opener(HTTPCookieProcessor(primenet_cj), TestHTTPHandler, TestHTTPSHandler)
+		my_opener = build_opener(TestHTTPHandler, TestHTTPSHandler)
+		install_opener(my_opener)
+		from random import seed
+		seed(3)
+		dump_state = True
+		now = lambda: 1591185600.0 # 2020-06-03 12:00:00 UTC
+		backoff_sleep = lambda seconds: None
+	elif options.debug == 2:
+		debug_print("Enable spying url request and responses")
+		from urllib_debug import SpyHTTPHandler, SpyHTTPSHandler
+		import_network()
+		# spy the requests sent through the connection pool
+		class SpyKeepAliveHTTPHandler(SpyHTTPHandler, KeepAliveHTTPHandler): pass
+		class SpyKeepAliveHTTPSHandler(SpyHTTPSHandler, KeepAliveHTTPSHandler): pass
+		install_openers(SpyKeepAliveHTTPHandler, SpyKeepAliveHTTPSHandler)
+
+	if options.trace:
+		tracer = Tracer(options.trace, options.trace_format)
+
+	# load local.ini of each workdir and update its options
+	workdirs = []
+	for dirname in expand_workdirs(options.workdir):
+		wd = Workdir(dirname, options)
+		if lock_workdir(wd):
+			workdirs.append(wd)
+		else:
+			debug_print("{0} is used by an other primenet.py process, skipping it".format(wd.dirname))
+	if not workdirs:
+		sys.exit(0)
+	for wd in workdirs:
+		if len(workdirs) > 1:
+			workdir_tag = wd.dirname + ": "
+		load_workdir(wd)
+	# the state of the circuit breaker is saved with the first workdir, so that a run
+	# from cron, or --register, doesn't hammer a failing server
+	retry_scheduler.load(workdirs[0].state)
+
+	if options.register:
+		try:
+			for wd in workdirs:
+				select_workdir(wd)
+				if len(workdirs) > 1:
+					workdir_tag = wd.dirname + ": "
+				# if guid already exist, recover it, this way, one can (re)register to change
+				# the CPU model (changing instance name can only be done in the website)
+				guid = get_guid(config)
+				with span("register_instance"):
+					register_instance(guid)
+		finally:
+			# also when register_instance exits on an error
+			retry_scheduler.save(workdirs[0].state)
+		if tracer is not None:
+			tracer.flush()
+		sys.exit(0)
+
+	if options.compact_sent:
+		for wd in workdirs:
+			select_workdir(wd)
+			compact_sent()
+		sys.exit(0)
+
+	for wd in workdirs:
+		if wd.options.username is None or wd.options.password is None:
+			parser.error("Username and password must be given")
+
+	# The session on www.mersenne.org is shared by all the workdirs, it is saved
+	# next to the local.ini of the first one and the login is done only when needed
+	cookies_file = os.path.join(workdirs[0].dirname, "primenet_cookies.txt")
+	if options.metrics_listen and options.timeout > 0:
+		serve_metrics(options.metrics_listen)
+
+	if options.profile:
+		profiler = Profiler(options.profile, max(options.profile_keep, 1), options.tracemalloc)
+		if options.timeout > 0 and hasattr(signal, "SIGUSR1"):
+			signal.signal(signal.SIGUSR1, profiler.report)
+
+	watcher = None
+	if options.watch and options.timeout > 0:
+		watcher = FileWatcher([wd.dirname for wd in workdirs])
+
+	while True:
+		with span("cycle", workdirs=len(workdirs)):
+			profile_cycle(update_workdirs, workdirs)
+		retry_scheduler.save(workdirs[0].state)
+		if tracer is not None:
+			tracer.flush()
+		metrics.set("primenet_cycle_timestamp_seconds", {}, now())
+		if options.metrics:
+			write_metrics(options.metrics)
+		if options.timeout <= 0:
+			break
+		delay = min(next_update.get(wd.dirname, options.timeout) for wd in workdirs)
+		debug_print("Next update in {0:.1f} hours".format(delay/3600))
+		try:
+			if watcher is None:
+				sleep_until(time() + delay)
+			else:
+				watch_workdirs(watcher, workdirs, delay)
+		except KeyboardInterrupt:
+			break
+
+	sys.exit(0)
 
-sys.exit(0)
+if __name__ == "__main__":
+	main()
 
 # vim: noexpandtab ts=4 sts=0 sw=0
@@ -1,14 +1,21 @@
+# usage: primenet_v5_hashing.py [results file...]
+# Check the SEC2 security codes of the results files given, or run the doctests without argument.
 
+from __future__ import print_function
+import re
 from hashlib import md5
 
 from random import getrandbits
-def add_secure_v5_args(args, guid, salt=None):
-	"""Add sh and ss arguments given a random salt (to sh) and the key derived from guid.
-	guid must be a 32-byte hexa string, as used in the 'g' args of V5 API
-	>>> add_secure_v5_args("v=0.95&px=GIMPS&t=ap&g=0807e4456339466376bcf63436fe5176&k=51D7100698D8B18893B7BE2AB5FDCEBC&stage=LL&c=0&p=83.0492&d=86400&e=1268735&iteration=85000000&res64=9CE24584CD974BF0&ec=00000000", "0807e4456339466376bcf63436fe5176", 40830)
-	'v=0.95&px=GIMPS&t=ap&g=0807e4456339466376bcf63436fe5176&k=51D7100698D8B18893B7BE2AB5FDCEBC&stage=LL&c=0&p=83.0492&d=86400&e=1268735&iteration=85000000&res64=9CE24584CD974BF0&ec=00000000&ss=40830&sh=DF7FD29CA068A0ED1843F4BB85840F3B'
+
+key_cache = {}
+def secure_v5_key(guid):
+	"""Return the key derived from guid, computed only once for each guid
+	>>> secure_v5_key("0807e4456339466376bcf63436fe5176") is secure_v5_key("0807e4456339466376bcf63436fe5176")
+	True
 """
-	# derive the key
+	key = key_cache.get(guid)
+	if key is not None:
+		return key
 	h = bytearray(md5(guid.encode('ascii')).digest()) # h is 16 bytes long bytearray(), which is mutable unlike bytes(), guid must be ASCII char, fail if it isn't
 	for i in range(16):
 		d = c = h[i]
@@ -16,6 +23,16 @@ def add_secure_v5_args(args, guid, salt=None):
 		d = (d ^ 0x45) ^ h[c]
 		h[i] = d # mutability used
 	key = md5(bytes(h)).hexdigest().upper() # the bytes() convertion is necessary for python2.6 and before
+	key_cache[guid] = key
+	return key
+
+def add_secure_v5_args(args, guid, salt=None):
+	"""Add sh and ss arguments given a random salt (to sh) and the key derived from guid.
+	guid must be a 32-byte hexa string, as used in the 'g' args of V5 API
+	>>> add_secure_v5_args("v=0.95&px=GIMPS&t=ap&g=0807e4456339466376bcf63436fe5176&k=51D7100698D8B18893B7BE2AB5FDCEBC&stage=LL&c=0&p=83.0492&d=86400&e=1268735&iteration=85000000&res64=9CE24584CD974BF0&ec=00000000", "0807e4456339466376bcf63436fe5176", 40830)
+	'v=0.95&px=GIMPS&t=ap&g=0807e4456339466376bcf63436fe5176&k=51D7100698D8B18893B7BE2AB5FDCEBC&stage=LL&c=0&p=83.0492&d=86400&e=1268735&iteration=85000000&res64=9CE24584CD974BF0&ec=00000000&ss=40830&sh=DF7FD29CA068A0ED1843F4BB85840F3B'
+"""
+	key = secure_v5_key(guid)
 	if salt is None:
 		salt = getrandbits(16)
 	args += "&ss="+str(salt)+"&"
@@ -112,6 +129,79 @@ def SEC3(p):
 	'7D4E7FCF'
     """
 
+def load_numpy():
+	"""Import NumPy when a batch is computed, so that the v5 signature doesn't need it.
+	Return None if it isn't installed"""
+	try:
+		import numpy
+	except ImportError:
+		return None
+	return numpy
+
+def SEC1_batch(p):
+	"""SEC1 of each exponent of p, as integers: a NumPy array, or a list without NumPy.
+	>>> ["{:08X}".format(int(x)) for x in SEC1_batch([10388359, 10391921, 10391923, 10391933, 10391977])]
+	['A49D230E', 'C0713EE2', 'C0753EE6', 'C0893EFA', 'C0E13F52']
+	"""
+	np = load_numpy()
+	if np is None:
+		return [int(SEC1(x), 16) for x in p]
+	p = np.asarray(p, dtype=np.uint64)
+	ans = p%27951 + p%88311 + (((p%19019 + p%63111)&0xffff) <<16)
+	return ans%0xffffffff
+
+def SEC2_batch(shift_count, error_count, res64, p):
+	"""SEC2 of each result given by the sequences shift_count, error_count, res64 and p,
+	as integers: a NumPy array, or a list without NumPy.
+	>>> ["{:08X}".format(int(x)) for x in SEC2_batch([27224212, 79015339, 64982], [0, 0, 0], [0x8D1346B59440C81D, 0x1B30A053FEBFE8C6, 0xB891C17502F8A985], [46481819, 81686573, 91700491])]
+	['F50E12E8', '140685EE', '29E17951']
+	"""
+	np = load_numpy()
+	if np is None:
+		return [int(SEC2(*args), 16) for args in zip(shift_count, error_count, res64, p)]
+	res64 = np.asarray(res64, dtype=np.uint64)
+	p = np.asarray(p, dtype=np.uint64)
+	high32 = res64>>32
+	low32 = res64&0xffffffff
+	a0 = (np.asarray(shift_count, dtype=np.uint64)+np.asarray(error_count, dtype=np.uint64)+high32+low32)&0xffffffff
+	a1 = (p%4219 + p%91631 + ((p%15923+p%62071)<<16))%0xffffffff
+	return a0^a1
+
+# The LL/PRP results of prime95 end with "Wxx: SEC2,shift count,error count", as in
+# M46481819 is not prime. Res64: 8D1346B59440C81D. We4: F50E12E8,27224212,00000000
+sec2_line_regex = re.compile(r"^M([0-9]+) .*Res64: ([0-9A-F]{16})\. W[a-z][0-9]: ([0-9A-F]{8}),([0-9]+),([0-9A-F]{8})")
+
+def read_sec2_lines(File, batch_size):
+	"""Yield the results of File with a SEC2, by lists of at most batch_size (line number, line, fields)"""
+	batch = []
+	for lineno, line in enumerate(File, 1):
+		res = sec2_line_regex.search(line)
+		if res:
+			batch.append((lineno, line.rstrip(), res.groups()))
+			if len(batch) == batch_size:
+				yield batch
+				batch = []
+	if batch:
+		yield batch
+
+def check_results(filename, batch_size=65536):
+	"""Recompute the SEC2 of the results of filename by batches of batch_size lines,
+	print the lines where it doesn't match the one written and return their count"""
+	mismatches = 0
+	with open(filename) as File:
+		for batch in read_sec2_lines(File, batch_size):
+			p, res64, sec2, shift_count, error_count = zip(*[fields for lineno, line, fields in batch])
+			computed = SEC2_batch([int(x) for x in shift_count], [int(x, 16) for x in error_count],
+				[int(x, 16) for x in res64], [int(x) for x in p])
+			for (lineno, line, fields), code in zip(batch, computed):
+				if int(fields[2], 16) != code:
+					mismatches += 1
+					print("{0}:{1}: SEC2 should be {2:08X}: {3}".format(filename, lineno, int(code), line))
+	return mismatches
+
 if __name__ == "__main__":
+	import sys
+	if len(sys.argv) > 1:
+		sys.exit(1 if sum(check_results(filename) for filename in sys.argv[1:]) else 0)
 	import doctest
 	doctest.testmod()
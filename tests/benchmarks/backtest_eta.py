@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Backtest of the ETA estimations on recorded p*.stat files.
+# For each file, the time to reach its last Iter# line is estimated as update_progress()
+# does at several points of the test, and compared to the time recorded by the Iter# lines:
+# - "head" is the ETA of the assignment being tested, from its own stat file
+# - "queued" is the ETA of the assignment if it was waiting in worktodo.ini, with
+#   the speed table built from the other files (FFT length + N log N model), compared
+#   to the previous estimation using the speed of the other assignment.
+# Without file, the stat files recorded for the golden tests (tests/test_*/p*.stat) are used.
+# usage: backtest_eta.py [p*.stat ...]
+
+from __future__ import division, print_function
+import os
+import re
+import sys
+import shutil
+import tempfile
+from datetime import datetime
+from glob import glob
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import primenet
+
+line_regex = re.compile(r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] M(\d+) Iter# = (\d+) ")
+
+def read_history(statfile):
+	"""Return p, the FFT length and the (date in seconds, iteration) of each Iter# line"""
+	p, history = None, []
+	epoch = datetime(1970, 1, 1)
+	for line in primenet.readonly_list_file(statfile):
+		res = line_regex.search(line)
+		if res:
+			when = datetime.strptime(res.group(1), "%Y-%m-%d %H:%M:%S")
+			p = int(res.group(2))
+			history.append(((when - epoch).total_seconds(), int(res.group(3))))
+	primenet.stat_cache.clear()
+	primenet.parse_stat_file(statfile)
+	return p, primenet.stat_fft_length(statfile), history
+
+def truncated_stat_file(statfile, history, count, tmpdir):
+	"""Copy of statfile with its header and its first count Iter# lines"""
+	lines = primenet.readonly_list_file(statfile)
+	kept, found = [], 0
+	for line in lines:
+		if line_regex.search(line):
+			found += 1
+			if found > count:
+				break
+		kept.append(line)
+	filename = os.path.join(tmpdir, os.path.basename(statfile))
+	primenet.write_list_file(filename, kept)
+	return filename
+
+def backtest(statfiles, tmpdir):
+	runs = [(statfile,) + read_history(statfile) for statfile in statfiles]
+	runs = [run for run in runs if len(run[3]) >= 10]
+	head_errors, queued_errors, previous_errors = [], [], []
+	print("{0:>12s} {1:>7s} {2:>6s} {3:>10s} {4:>10s} {5:>10s}".format("p", "FFT", "done", "head", "queued", "previous"))
+	for statfile, p, fft_length, history in runs:
+		end, last_iteration = history[-1]
+		others = [run for run in runs if run[0] != statfile]
+		# the speed table of the other tests, and the speed of the last one as before
+		speed_table = {}
+		for _, other_p, other_fft_length, other_history in others:
+			(t0, i0), (t1, i1) = other_history[0], other_history[-1]
+			speed_table[other_fft_length] = (t1 - t0)/(i1 - i0)*1000
+		previous_speed = speed_table[others[-1][2]] if others else None
+		for fraction in (0.1, 0.25, 0.5, 0.75, 0.9):
+			count = max(1, int(len(history)*fraction))
+			when, iteration = history[count-1]
+			primenet.stat_cache.clear()
+			_, usec_per_iter = primenet.parse_stat_file(truncated_stat_file(statfile, history, count, tmpdir))
+			real_left = end - when
+			head_left, queued_left, previous_left = (time_to(p, iteration, last_iteration, speed)
+				for speed in (usec_per_iter, primenet.estimate_usec_per_iter(p, None, speed_table), previous_speed))
+			errors = [None if left is None else 100*(left - real_left)/real_left for left in (head_left, queued_left, previous_left)]
+			for error, errors_list in zip(errors, (head_errors, queued_errors, previous_errors)):
+				if error is not None:
+					errors_list.append(abs(error))
+			print("{0:12d} {1:6d}K {2:5.0f}% {3}".format(p, fft_length or 0, 100*iteration/p,
+				" ".join("{0:>+9.1f}%".format(error) if error is not None else "{0:>10s}".format("-") for error in errors)))
+	for name, errors in (("head", head_errors), ("queued", queued_errors), ("previous", previous_errors)):
+		if errors:
+			print("{0:10s} mean absolute error {1:6.1f}%, max {2:6.1f}% on {3} estimations".format(name, sum(errors)/len(errors), max(errors), len(errors)))
+
+def time_to(p, iteration, last_iteration, usec_per_iter):
+	"""Estimated seconds from iteration to last_iteration, from the ETAs of the end of the test"""
+	_, left = primenet.compute_progress(p, iteration, usec_per_iter)
+	_, last_left = primenet.compute_progress(p, last_iteration, usec_per_iter)
+	return None if left is None else left - last_left
+
+def recorded_stat_files():
+	"""The stat files of the golden tests, the symbolic links to the same file are only taken once"""
+	tests_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+	return sorted(set(os.path.realpath(statfile) for statfile in glob(os.path.join(tests_dir, "test_*", "p*.stat"))))
+
+def main():
+	tmpdir = tempfile.mkdtemp()
+	try:
+		backtest(sys.argv[1:] or recorded_stat_files(), tmpdir)
+	finally:
+		shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+	main()
+
+# vim: noexpandtab ts=4 sts=0 sw=0
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark of SEC2_batch() on a synthetic results file, compared to the scalar SEC2(),
+# and of the whole check of the file by check_results().
+# usage: bench_sec_batch.py [number of results]
+
+from __future__ import division, print_function
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import primenet_v5_hashing
+from primenet_v5_hashing import SEC2, SEC2_batch, check_results
+from synthetic import write_results_file
+
+def best_of(func, number):
+	return min(timeit.repeat(func, number=number, repeat=3))/number
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	if primenet_v5_hashing.load_numpy() is None:
+		print("NumPy is not installed, SEC2_batch() uses the scalar SEC2()")
+	tmpdir = tempfile.mkdtemp()
+	try:
+		resultsfile = os.path.join(tmpdir, "results_sent.txt")
+		write_results_file(resultsfile, count)
+		with open(resultsfile) as File:
+			fields = [res.groups() for res in map(primenet_v5_hashing.sec2_line_regex.search, File)]
+		p = [int(f[0]) for f in fields]
+		res64 = [int(f[1], 16) for f in fields]
+		shift_count = [int(f[3]) for f in fields]
+		error_count = [int(f[4], 16) for f in fields]
+		print("{0}: {1:.1f} MB, {2} results".format(resultsfile, os.path.getsize(resultsfile)/1024/1024, count))
+		assert [int(SEC2(*args), 16) for args in zip(shift_count, error_count, res64, p)] == [int(x) for x in SEC2_batch(shift_count, error_count, res64, p)]
+
+		devnull = open(os.devnull, "w")
+		stdout = sys.stdout
+		def check():
+			sys.stdout = devnull
+			try:
+				assert check_results(resultsfile) == 0
+			finally:
+				sys.stdout = stdout
+		results = [
+			("SEC2, scalar", best_of(lambda: [SEC2(*args) for args in zip(shift_count, error_count, res64, p)], 1)),
+			("SEC2_batch", best_of(lambda: SEC2_batch(shift_count, error_count, res64, p), 1)),
+			("check_results, whole file", best_of(check, 1)),
+		]
+		devnull.close()
+		for name, duration in results:
+			print("{0:30s} {1:10.1f} ms {2:8.0f} results/s".format(name, duration*1000, count/duration))
+	finally:
+		shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+	main()
+
+# vim: noexpandtab ts=4 sts=0 sw=0
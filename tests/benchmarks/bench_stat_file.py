@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark of parse_stat_file() on a synthetic multi-megabyte p*.stat file,
+# compared to the previous implementation reading the whole file.
+# usage: bench_stat_file.py [size in MB]
+
+from __future__ import division, print_function
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import primenet
+from synthetic import write_stat_file, append_stat_lines
+
+def parse_stat_file_full_read(statfile):
+	"""The previous implementation, reading the whole file in a list"""
+	w = primenet.readonly_list_file(statfile)
+	found = 0
+	list_usec_per_iter = []
+	for line in reversed(w):
+		res = primenet.stat_regex.search(line)
+		if res:
+			found += 1
+			if found == 1:
+				iteration = int(res.group(1))
+			usec_per_iter = float(res.group(2))
+			if res.group(3) == "sec":
+				usec_per_iter *= 1000
+			list_usec_per_iter.append(usec_per_iter)
+			if found == 5: break
+	if found == 0: return 0, None
+	return iteration, primenet.median_low(list_usec_per_iter)
+
+def best_of(func, number):
+	return min(timeit.repeat(func, number=number, repeat=5))/number
+
+def main():
+	size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+	p = 332220523
+	tmpdir = tempfile.mkdtemp()
+	try:
+		statfile = os.path.join(tmpdir, "p{0}.stat".format(p))
+		count = int(size_mb*1024*1024/230) # about 230 bytes per Iter# line
+		write_stat_file(statfile, p, count)
+		print("{0}: {1:.1f} MB, {2} Iter# lines".format(statfile, os.path.getsize(statfile)/1024/1024, count))
+		assert parse_stat_file_full_read(statfile) == primenet.parse_stat_file(statfile)
+
+		def first_scan():
+			# read back to the last restart for the FFT length
+			primenet.stat_cache.clear()
+			primenet.parse_stat_file(statfile)
+		iteration = [10000*(count+1)]
+		def appended():
+			# one new Iter# line since the previous scan, as in a daemon cycle
+			append_stat_lines(statfile, p, iteration[0], 1)
+			iteration[0] += 10000
+			primenet.parse_stat_file(statfile)
+		store = primenet.StateStore(os.path.join(tmpdir, "primenet.db"))
+		primenet.parse_stat_file(statfile, store)
+		def new_run():
+			# one new Iter# line since the previous run, as in a cron run (-t 0),
+			# which continues the scan saved in primenet.db
+			primenet.stat_cache.clear()
+			append_stat_lines(statfile, p, iteration[0], 1)
+			iteration[0] += 10000
+			primenet.parse_stat_file(statfile, store)
+		results = [
+			("full read (previous)", best_of(lambda: parse_stat_file_full_read(statfile), 3)),
+			("tail read, first scan", best_of(first_scan, 100)),
+			("tail read, unchanged", best_of(lambda: primenet.parse_stat_file(statfile), 1000)),
+			("tail read, 1 line appended", best_of(appended, 100)),
+			("new run, 1 line appended", best_of(new_run, 100)),
+		]
+		for name, duration in results:
+			print("{0:30s} {1:10.3f} ms".format(name, duration*1000))
+	finally:
+		shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+	main()
+
+# vim: noexpandtab ts=4 sts=0 sw=0
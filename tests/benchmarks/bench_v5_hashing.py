@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark of the signature of the v5 requests by add_secure_v5_args(),
+# with the key derived from the GUID at each call or cached,
+# compared to the urlencode() of the arguments that send_request() does anyway.
+# usage: bench_v5_hashing.py [number of GUIDs]
+
+from __future__ import division, print_function
+import os
+import sys
+import timeit
+from random import getrandbits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import primenet
+import primenet_v5_hashing
+
+def best_of(func, number):
+	return min(timeit.repeat(func, number=number, repeat=5))/number
+
+def main():
+	# urlencode is imported with the HTTP modules, before the first request
+	primenet.import_network()
+	guid_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+	guids = ["{0:032x}".format(getrandbits(128)) for i in range(guid_count)]
+	args = primenet.OrderedDict((
+		("px", "GIMPS"), ("v", 0.95), ("t", "ap"),
+		("k", "5FFFA71F8C4551B8A519C1E68E8F62F1"), ("p", "48.5602"), ("d", 86400),
+		("e", 1093524), ("c", 0), ("stage", "LL"), ("g", guids[0])))
+	url_args = primenet.urlencode(args)
+	i = [0]
+	def next_guid():
+		i[0] = (i[0] + 1) % guid_count
+		return guids[i[0]]
+
+	def encode():
+		primenet.urlencode(args)
+	def uncached():
+		primenet_v5_hashing.key_cache.clear()
+		primenet_v5_hashing.add_secure_v5_args(url_args, next_guid())
+	def cached():
+		primenet_v5_hashing.add_secure_v5_args(url_args, next_guid())
+
+	number = 20000
+	t_encode = best_of(encode, number)
+	t_uncached = best_of(uncached, number)
+	t_cached = best_of(cached, number)
+	print("{0} GUID(s), {1} bytes of arguments".format(guid_count, len(url_args)))
+	print("urlencode:          {0:7.2f} us/request".format(t_encode*1e6))
+	print("signed, key derived:{0:7.2f} us/request".format(t_uncached*1e6))
+	print("signed, key cached: {0:7.2f} us/request ({1:.1f}x faster, {2:.0f}% of urlencode)".format(
+		t_cached*1e6, t_uncached/t_cached, 100*t_cached/t_encode))
+	print("1 million requests: {0:.2f} s of CPU to sign them".format(t_cached*1e6))
+
+if __name__ == "__main__":
+	main()
+
+# vim: noexpandtab ts=4 sts=0 sw=0
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Load test of primenet.py against the local stand-in of the PrimeNet server (tests/primenet_server.py).
+# A fleet of registered Mlucas instances is simulated by as many workdirs, shared by several
+# primenet.py processes run at the same time (-w with a glob pattern). At each cycle, every
+# instance finishes its first assignment: the cycle sends its result, its progress and gets a
+# new assignment. The throughput of the server and the resources used by the clients are reported.
+# usage: load_test.py [--clients 1000] [--processes 10] [--cycles 3] [--latency 0.05] [--error SERVER_BUSY:0.01]
+
+from __future__ import division, print_function
+import os
+import sys
+import shutil
+import resource
+import tempfile
+from optparse import OptionParser
+from random import Random
+from subprocess import Popen
+from time import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, "..", ".."))
+sys.path.insert(0, os.path.join(bench_dir, ".."))
+import primenet
+import primenet_server
+from synthetic import write_stat_file, mlucas_result_line
+from datetime import datetime
+
+def create_clients(tmpdir, clients, processes, num_cache):
+	"""Create the workdirs of the clients, in one directory by process"""
+	rng = Random(0)
+	for i in range(clients):
+		dirname = os.path.join(tmpdir, "process{0}".format(i % processes), "client{0}".format(i))
+		os.makedirs(dirname)
+		guid = "{0:032x}".format(rng.getrandbits(128))
+		primenet.write_list_file(os.path.join(dirname, "local.ini"), ["[primenet]", "guid = " + guid,
+			"username = fleet", "password = fleet", "num_cache = {0}".format(num_cache), "work_preference = 101," + guid])
+		tasks = ["DoubleCheck={0:032X},{1},74,1".format(rng.getrandbits(128), rng.randrange(55000000, 60000000) | 1) for n in range(num_cache)]
+		primenet.write_list_file(os.path.join(dirname, "worktodo.ini"), tasks)
+		p = int(tasks[0].split(",")[1])
+		write_stat_file(os.path.join(dirname, "p{0}.stat".format(p)), p, 100)
+
+def finish_assignments(tmpdir, rng):
+	"""Each client finishes its first assignment, as Mlucas does"""
+	for process in os.listdir(tmpdir):
+		for client in os.listdir(os.path.join(tmpdir, process)):
+			dirname = os.path.join(tmpdir, process, client)
+			workfile = os.path.join(dirname, "worktodo.ini")
+			primenet.write_list_file(workfile, primenet.readonly_list_file(workfile)[1:])
+			primenet.write_list_file(os.path.join(dirname, "results.txt"), [mlucas_result_line(rng, datetime.now())], "a")
+
+def run_cycle(tmpdir, processes, url, extra_args):
+	"""Run a primenet.py process for each directory of clients, return the duration"""
+	start = time()
+	children = [Popen([sys.executable, os.path.join(bench_dir, "..", "..", "primenet.py"),
+		"-w", os.path.join(tmpdir, "process{0}".format(i), "*"), "-t", "0",
+		"--v5_url", url + "v5server/?", "--www_url", url] + extra_args) for i in range(processes)]
+	failed = sum(1 for child in children if child.wait() != 0)
+	if failed:
+		print("{0} primenet.py processes failed".format(failed), file=sys.stderr)
+	return time() - start
+
+def main():
+	parser = OptionParser(usage="%prog [options]")
+	parser.add_option("--clients", dest="clients", type="int", default=1000, help="Number of simulated Mlucas instances, default %default")
+	parser.add_option("--processes", dest="processes", type="int", default=10, help="Number of primenet.py run at the same time, default %default")
+	parser.add_option("--cycles", dest="cycles", type="int", default=3, help="Number of cycles, default %default")
+	parser.add_option("--num_cache", dest="num_cache", type="int", default=2, help="Assignments queued by each client, default %default")
+	parser.add_option("--max_in_flight", dest="max_in_flight", default="1", help="--max_in_flight of primenet.py, default %default")
+	parser.add_option("--latency", dest="latency", type="float", default=0, help="Seconds added by the server to each answer, default %default")
+	parser.add_option("--jitter", dest="jitter", type="float", default=0, help="Random seconds added to the latency, default %default")
+	parser.add_option("--error", dest="errors", action="append", default=[], help="v5 error returned with a probability, like SERVER_BUSY:0.05")
+	parser.add_option("--http_error", dest="http_errors", action="append", default=[], help="HTTP status returned with a probability, like 503:0.01")
+	parser.add_option("--rate_limit", dest="rate_limit", type="float", default=0, help="Requests per second allowed by client, default: no limit")
+	(options, args) = parser.parse_args()
+
+	server_options = primenet_server.ServerOptions(options.latency, options.jitter,
+		primenet_server.parse_errors(options.errors, primenet.primenet_api),
+		primenet_server.parse_errors(options.http_errors), options.rate_limit)
+	server, url = primenet_server.start_server(options=server_options)
+	tmpdir = tempfile.mkdtemp()
+	try:
+		create_clients(tmpdir, options.clients, options.processes, options.num_cache)
+		rng = Random(1)
+		for cycle in range(options.cycles):
+			finish_assignments(tmpdir, rng)
+			duration = run_cycle(tmpdir, options.processes, url, ["--max_in_flight", options.max_in_flight])
+			print("cycle {0}: {1:.2f} s, {2:.1f} ms by client".format(cycle + 1, duration, 1000*duration/options.clients))
+	finally:
+		server.shutdown()
+		shutil.rmtree(tmpdir)
+	stats = server.counters.as_dict()
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	total = sum(stats["requests"].values())
+	print("server: {0} requests, {1:.0f} requests/s, {2} KB received, {3} KB sent".format(
+		total, stats["requests_per_second"], stats["bytes_in"]//1024, stats["bytes_out"]//1024))
+	for answer in sorted(stats["answers"]):
+		print("  {0:30s} {1}".format(answer, stats["answers"][answer]))
+	cycles = options.clients*options.cycles
+	# ru_maxrss is in KB on Linux
+	print("clients: {0:.2f} ms of CPU by client cycle, {1:.0f} MB max RSS of a process".format(
+		1000*(usage.ru_utime + usage.ru_stime)/cycles, usage.ru_maxrss/1024))
+
+if __name__ == "__main__":
+	main()
+
+# vim: noexpandtab ts=4 sts=0 sw=0
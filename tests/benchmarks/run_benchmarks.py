@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks of the hot paths of primenet.py on synthetic files at a realistic scale:
+# p*.stat scans, worktodo.ini scans, results deduplication, progress of long queues,
+# local.ini and primenet.db handling, and whole cycles against a local stand-in of the v5 server.
+# Each run is appended to a history file (JSON lines) and compared to the previous
+# run of the same host, python and scale, so that the regressions are visible.
+# usage: run_benchmarks.py [--scale 0.1] [--filter name] [--history file] [--no_save]
+
+from __future__ import division, print_function
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import timeit
+from time import gmtime, strftime
+from datetime import datetime
+from optparse import OptionParser
+from random import Random
+from subprocess import Popen, PIPE
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, "..", ".."))
+sys.path.insert(0, os.path.join(bench_dir, ".."))
+import primenet
+import primenet_server
+from synthetic import write_stat_file, append_stat_lines, write_worktodo_file, worktodo_lines, \
+	write_mlucas_results_file, mlucas_result_line
+
+guid = "07bd50dc0489bb4a44da5639df9889a8"
+
+def start_server():
+	"""Start the stand-in server and make primenet.py use it"""
+	server, url = primenet_server.start_server()
+	primenet.primenet_v5_burl = url + "v5server/?"
+	primenet.primenet_baseurl = url
+	primenet.install_openers()
+	return server
+
+#######################################################################################################
+# Benchmarks: each one prepares its files in tmpdir at the given scale,
+# and returns the function to time with the number of calls per measure
+#######################################################################################################
+
+benchmarks = []
+def benchmark(name):
+	def register(func):
+		benchmarks.append((name, func))
+		return func
+	return register
+
+def open_workdir(dirname, *args):
+	"""Load the workdir as main() does, registered with guid"""
+	if not os.path.isdir(dirname):
+		os.makedirs(dirname)
+	localfile = os.path.join(dirname, "local.ini")
+	if not os.path.exists(localfile):
+		primenet.write_list_file(localfile, ["[primenet]", "guid = " + guid])
+	options, _ = primenet.parser.parse_args(["-w", dirname, "-u", "bench", "-p", "bench"] + list(args))
+	primenet.options = options
+	wd = primenet.Workdir(dirname, options)
+	primenet.load_workdir(wd)
+	return wd
+
+def stat_file(tmpdir, scale, p=332220523):
+	statfile = os.path.join(tmpdir, "p{0}.stat".format(p))
+	write_stat_file(statfile, p, max(10, int(scale*8*1024*1024/230))) # 8 MB, about 230 bytes per Iter# line
+	return statfile
+
+@benchmark("parse_stat_file, 8 MB, cold")
+def bench_stat_cold(tmpdir, scale):
+	statfile = stat_file(tmpdir, scale)
+	def run():
+		primenet.stat_cache.clear()
+		primenet.parse_stat_file(statfile)
+	return run, 100
+
+@benchmark("parse_stat_file, 8 MB, 1 line appended")
+def bench_stat_appended(tmpdir, scale):
+	p = 332220523
+	statfile = stat_file(tmpdir, scale, p)
+	primenet.parse_stat_file(statfile)
+	iteration = [10000*10**6]
+	def run():
+		append_stat_lines(statfile, p, iteration[0], 1)
+		iteration[0] += 10000
+		primenet.parse_stat_file(statfile)
+	return run, 100
+
+@benchmark("greplike(workpattern), 10^5 worktodo lines")
+def bench_worktodo(tmpdir, scale):
+	workfile = os.path.join(tmpdir, "worktodo.ini")
+	write_worktodo_file(workfile, max(10, int(scale*10**5)))
+	return lambda: primenet.greplike(primenet.workpattern, primenet.readonly_list_file(workfile)), 3
+
+def results_workdir(tmpdir, scale, name):
+	"""Workdir where the 10^5 results of results.txt are already sent"""
+	wd = os.path.join(tmpdir, name)
+	os.makedirs(wd)
+	count = max(10, int(scale*10**5))
+	write_mlucas_results_file(os.path.join(wd, "results.txt"), count)
+	shutil.copy(os.path.join(wd, "results.txt"), os.path.join(wd, "results_sent.txt"))
+	return open_workdir(wd, "-t", "0")
+
+@benchmark("submit_work, 10^5 sent results, full scan")
+def bench_submit_scan(tmpdir, scale):
+	wd = results_workdir(tmpdir, scale, "submit_scan")
+	def run():
+		# as the first cycle after an upgrade, without saved offset
+		primenet.state.remove_option("primenet", "results_offset")
+		primenet.submit_work()
+	return run, 3
+
+@benchmark("submit_work, 10^5 sent results, 1 new")
+def bench_submit_new(tmpdir, scale):
+	wd = results_workdir(tmpdir, scale, "submit_new")
+	primenet.submit_work()
+	rng = Random(1)
+	def run():
+		primenet.write_list_file(wd.resultsfile, [mlucas_result_line(rng, datetime.now())], "a")
+		primenet.submit_work()
+	return run, 20
+
+def queue_workdir(tmpdir, scale, name):
+	"""Workdir with a queue of 1000 assignments, the first one being tested"""
+	wd = os.path.join(tmpdir, name)
+	os.makedirs(wd)
+	tasks = [line for line in worktodo_lines(max(2, int(scale*1300))) if not line.startswith("#")]
+	primenet.write_list_file(os.path.join(wd, "worktodo.ini"), tasks)
+	head = primenet.workpattern.search(tasks[0])
+	p = primenet.get_exponent(tasks[0], head.group(1) == "PRP")
+	write_stat_file(os.path.join(wd, "p{0}.stat".format(p)), p, 500)
+	# run from cron: in daemon mode, each cycle sends the progress as the server expects it
+	wd = open_workdir(wd, "-t", "0")
+	# the first update sends the progress of all the assignments
+	primenet.update_progress()
+	return wd
+
+@benchmark("update_progress, 1000 assignments, unchanged")
+def bench_update_progress(tmpdir, scale):
+	queue_workdir(tmpdir, scale, "update_progress")
+	return primenet.update_progress, 10
+
+@benchmark("config_read + merge_config_and_options, 1000 assignments")
+def bench_config_read(tmpdir, scale):
+	queue_workdir(tmpdir, scale, "config_read")
+	return lambda: primenet.merge_config_and_options(primenet.config_read(), primenet.options), 20
+
+@benchmark("config_write, 1000 assignments")
+def bench_config_write(tmpdir, scale):
+	queue_workdir(tmpdir, scale, "config_write")
+	return lambda: primenet.config_write(primenet.config), 20
+
+@benchmark("cycle, 1 assignment done, stand-in server")
+def bench_cycle(tmpdir, scale):
+	wd = os.path.join(tmpdir, "cycle")
+	os.makedirs(wd)
+	write_mlucas_results_file(os.path.join(wd, "results.txt"), max(10, int(scale*1000)))
+	shutil.copy(os.path.join(wd, "results.txt"), os.path.join(wd, "results_sent.txt"))
+	wd = open_workdir(wd, "-t", str(6*3600), "-n", "2")
+	primenet.get_assignment(None)
+	rng = Random(2)
+	def run():
+		# Mlucas finished the first assignment: its result is appended and it is removed from worktodo.ini
+		tasks = primenet.readonly_list_file(wd.workfile)
+		primenet.write_list_file(wd.workfile, tasks[1:])
+		primenet.write_list_file(wd.resultsfile, [mlucas_result_line(rng, datetime.now())], "a")
+		primenet.submit_work()
+		progress = primenet.update_progress()
+		primenet.get_assignment(progress)
+	return run, 10
+
+#######################################################################################################
+# History of the results
+#######################################################################################################
+
+def git_commit():
+	try:
+		process = Popen(["git", "rev-parse", "--short", "HEAD"], cwd=bench_dir, stdout=PIPE, stderr=PIPE)
+	except OSError:
+		return None
+	out = process.communicate()[0].decode("utf-8", "replace").strip()
+	return out if process.returncode == 0 else None
+
+def read_history(filename):
+	history = []
+	for line in primenet.readonly_list_file(filename):
+		try:
+			history.append(json.loads(line))
+		except ValueError:
+			continue
+	return history
+
+def previous_result(history, run, name):
+	"""The duration of the benchmark name in the last comparable run: same host, python and scale"""
+	for previous in reversed(history):
+		if name in previous.get("results", {}) and all(previous.get(key) == run[key] for key in ("host", "python", "scale")):
+			return previous["results"][name]
+	return None
+
+def best_of(func, number, repeat=5):
+	return min(timeit.repeat(func, number=number, repeat=repeat))/number
+
+def main():
+	parser = OptionParser(usage="%prog [options]")
+	parser.add_option("-s", "--scale", dest="scale", type="float", default=1, help="Size of the synthetic files relative to the realistic ones, default %default")
+	parser.add_option("-k", "--filter", dest="filter", default="", help="Run only the benchmarks whose name contains this string")
+	parser.add_option("--history", dest="history", default=os.path.join(bench_dir, "history.jsonl"), help="File where the results are appended, default %default")
+	parser.add_option("--no_save", action="store_true", dest="no_save", default=False, help="Don't append the results to the history")
+	parser.add_option("--threshold", dest="threshold", type="float", default=20, help="Slowdown in percent from the previous run reported as a regression, default %default")
+	(options, args) = parser.parse_args()
+
+	run = {
+		"date": strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()),
+		"commit": git_commit(),
+		"host": platform.node(),
+		"python": platform.python_version(),
+		"scale": options.scale,
+		"results": {},
+	}
+	history = read_history(options.history)
+	regressions = 0
+	server = start_server()
+	tmpdir = tempfile.mkdtemp()
+	try:
+		for i, (name, setup) in enumerate(benchmarks):
+			if options.filter not in name:
+				continue
+			casedir = os.path.join(tmpdir, str(i))
+			os.mkdir(casedir)
+			func, number = setup(casedir, options.scale)
+			duration = best_of(func, number)
+			run["results"][name] = duration
+			line = "{0:60s} {1:10.3f} ms".format(name, duration*1000)
+			previous = previous_result(history, run, name)
+			if previous is not None:
+				change = 100*(duration/previous - 1)
+				line += " {0:+7.1f}%".format(change)
+				if change > options.threshold:
+					line += " REGRESSION"
+					regressions += 1
+			print(line)
+			sys.stdout.flush()
+	finally:
+		server.shutdown()
+		shutil.rmtree(tmpdir)
+	if not options.no_save:
+		with open(options.history, "a") as File:
+			File.write(json.dumps(run, sort_keys=True) + "\n")
+	sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+	main()
+
+# vim: noexpandtab ts=4 sts=0 sw=0
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Generators of synthetic Mlucas files, at a realistic scale, for the benchmarks.
+
+from __future__ import division, print_function
+import random
+from datetime import datetime, timedelta
+
+def stat_header(p, fft_k=3072):
+	return [
+		"INFO: primary restart file p{0} not found...looking for secondary...".format(p),
+		"INFO: no restart file found...starting run from scratch.",
+		"M{0}: using FFT length {1}K = {2} 8-byte floats, initial residue shift count = 18715841".format(p, fft_k, fft_k*1024),
+		" this gives an average   17.502769152323406 bits per digit",
+		"Using complex FFT radices       192        16        16        32",
+	]
+
+def stat_line(p, iteration, msec_per_iter, when):
+	"""One Iter# line as written by Mlucas every 10000 iterations"""
+	return "[{0}] M{1} Iter# = {2} [{3:5.2f}% complete] clocks = 00:10:40.964 [ {4:.4f} msec/iter] Res64: E58C58A80C14B71B. AvgMaxErr = 0.105437500. MaxErr = 0.156250000. Residue shift count = 36291309.".format(
+		when.strftime("%Y-%m-%d %H:%M:%S"), p, iteration, 100*iteration/p, msec_per_iter)
+
+def stat_lines(p, first_iteration, count, msec_per_iter=64.0964, start=datetime(2020, 4, 4, 10, 30, 38), step=10000):
+	when = start
+	for i in range(count):
+		iteration = first_iteration + i*step
+		yield stat_line(p, iteration, msec_per_iter, when)
+		when += timedelta(seconds=msec_per_iter*step/1000)
+
+def write_stat_file(filename, p, count, msec_per_iter=64.0964, fft_k=3072):
+	"""Write a p*.stat file with count Iter# lines, like a test running since a long time"""
+	with open(filename, "w") as File:
+		for line in stat_header(p, fft_k):
+			print(line, file=File)
+		for line in stat_lines(p, 10000, count, msec_per_iter):
+			print(line, file=File)
+
+def append_stat_lines(filename, p, first_iteration, count, msec_per_iter=64.0964):
+	with open(filename, "a") as File:
+		for line in stat_lines(p, first_iteration, count, msec_per_iter):
+			print(line, file=File)
+
+def result_lines(count, seed=0):
+	"""LL results of prime95 with their SEC2, as appended to results_sent.txt"""
+	import primenet_v5_hashing
+	rng = random.Random(seed)
+	for i in range(count):
+		p = rng.randrange(50000000, 120000000) | 1
+		shift_count = rng.randrange(p)
+		res64 = rng.getrandbits(64)
+		yield "M{0} is not prime. Res64: {1:016X}. We4: {2},{3},00000000".format(
+			p, res64, primenet_v5_hashing.SEC2(shift_count, 0, res64, p), shift_count)
+
+def write_results_file(filename, count):
+	with open(filename, "w") as File:
+		for line in result_lines(count):
+			print(line, file=File)
+
+def random_aid(rng):
+	return "{0:032X}".format(rng.getrandbits(128))
+
+def worktodo_lines(count, seed=0):
+	"""Assignments of the LL, double-check and PRP kinds, with some comments as added by hand"""
+	rng = random.Random(seed)
+	for i in range(count):
+		p = rng.randrange(50000000, 120000000) | 1
+		kind = rng.randrange(4)
+		if kind == 0:
+			yield "Test={0},{1},76,1".format(random_aid(rng), p)
+		elif kind == 1:
+			yield "DoubleCheck={0},{1},74,1".format(random_aid(rng), p)
+		elif kind == 2:
+			yield "PRP={0},1,2,{1},-1,77,0".format(random_aid(rng), p)
+		else:
+			yield "# M{0} moved from another computer".format(p)
+
+def write_worktodo_file(filename, count, seed=0):
+	with open(filename, "w") as File:
+		for line in worktodo_lines(count, seed):
+			print(line, file=File)
+
+def mlucas_result_line(rng, when):
+	p = rng.randrange(50000000, 120000000) | 1
+	return '{{"status":"C", "exponent":{0}, "worktype":"LL", "res64":"{1:016X}", "fft-length":3145728, "shift-count":{2}, "error-code":"00000000", "program":{{"name":"Mlucas", "version":"19.0"}}, "timestamp":"{3} GMT", "aid":"{4}"}}'.format(
+		p, rng.getrandbits(64), rng.randrange(p), when.strftime("%Y-%m-%d %H:%M:%S"), random_aid(rng))
+
+def mlucas_result_lines(count, seed=0, start=datetime(2015, 1, 1)):
+	"""JSON results of Mlucas, as appended to results.txt over the years"""
+	rng = random.Random(seed)
+	for i in range(count):
+		yield mlucas_result_line(rng, start + timedelta(hours=6*i))
+
+def write_mlucas_results_file(filename, count, seed=0, mode="w"):
+	with open(filename, mode) as File:
+		for line in mlucas_result_lines(count, seed):
+			print(line, file=File)
+
+# vim: noexpandtab ts=4 sts=0 sw=0
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Local stand-in of the PrimeNet server, to measure primenet.py at fleet scale without network access.
+# It implements the v5 transactions used by primenet.py (uc, po, ga, ap, ar) and the pages of
+# www.mersenne.org (default.php, manual_assignment, manual_result), with a configurable latency,
+# injected errors and a rate limit by client. GET /stats returns the counters as JSON.
+# usage: primenet_server.py [--port 8080] [--latency 0.1] [--error SERVER_BUSY:0.05] [--rate_limit 1]
+# and:   primenet.py --v5_url 'http://127.0.0.1:8080/v5server/?' --www_url http://127.0.0.1:8080/
+
+from __future__ import division, print_function
+import os
+import sys
+import json
+import threading
+from optparse import OptionParser
+from random import Random
+from time import sleep, time
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+	from urllib.parse import urlparse, parse_qs
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+	from urlparse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from primenet import primenet_api
+
+# work type -> (worktodo line, exponents range)
+work_types = {
+	100: ("Test={k},{n},76,1", (110000000, 120000000)),
+	101: ("DoubleCheck={k},{n},74,1", (55000000, 60000000)),
+	102: ("Test={k},{n},81,1", (332192831, 333000000)),
+	104: ("Test={k},{n},86,1", (332192831, 333000000)),
+	150: ("PRP={k},1,2,{n},-1,76,0", (110000000, 120000000)),
+	151: ("PRP={k},1,2,{n},-1,76,0,3,1", (80000000, 90000000)),
+	152: ("PRP={k},1,2,{n},-1,81,0", (332192831, 333000000)),
+	153: ("PRP={k},1,2,{n},-1,86,0", (332192831, 333000000)),
+}
+
+class ServerOptions(object):
+	"""Behavior of the stand-in server"""
+	def __init__(self, latency=0, jitter=0, errors=(), http_errors=(), rate_limit=0, burst=10, strict=False, seed=0):
+		self.latency = latency			# seconds added to each answer
+		self.jitter = jitter			# random seconds added to the latency, uniformly
+		self.errors = errors			# (v5 error code, probability) for each v5 transaction
+		self.http_errors = http_errors	# (HTTP status, probability) for each request
+		self.rate_limit = rate_limit	# requests per second by client, 0 for no limit
+		self.burst = burst				# requests a client can send at once before being limited
+		self.strict = strict			# check the GUIDs and assignment keys
+		self.seed = seed
+
+class Counters(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.requests = {}	# endpoint -> count
+		self.answers = {}	# endpoint:v5 error code or HTTP status -> count
+		self.bytes_in = self.bytes_out = 0
+		self.start = time()
+
+	def add(self, endpoint, answer, bytes_in, bytes_out):
+		with self.lock:
+			self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+			key = "{0}:{1}".format(endpoint, answer)
+			self.answers[key] = self.answers.get(key, 0) + 1
+			self.bytes_in += bytes_in
+			self.bytes_out += bytes_out
+
+	def as_dict(self):
+		with self.lock:
+			elapsed = time() - self.start
+			total = sum(self.requests.values())
+			return {"elapsed": elapsed, "requests": dict(self.requests), "answers": dict(self.answers),
+				"requests_per_second": total/elapsed if elapsed else 0,
+				"bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+
+class PrimeNetServer(ThreadingMixIn, HTTPServer):
+	"""The state of the server: computers, sessions and assignments, shared by the handler threads"""
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 1024 # thousands of clients may connect at the same time
+
+	def __init__(self, address, options=None):
+		HTTPServer.__init__(self, address, PrimeNetHandler)
+		self.options = options or ServerOptions()
+		self.lock = threading.Lock()
+		self.rng = Random(self.options.seed)
+		self.computers = {}		# guid -> args of uc
+		self.assignments = {}	# key -> (guid or user, exponent)
+		self.sessions = {}		# cookie -> user name
+		self.buckets = {}		# client -> (tokens, date)
+		self.counters = Counters()
+
+	def random_key(self):
+		with self.lock:
+			return "{0:032X}".format(self.rng.getrandbits(128))
+
+	def chance(self, probability):
+		with self.lock:
+			return self.rng.random() < probability
+
+	def allow(self, client):
+		"""Token bucket of the client, refilled at rate_limit tokens per second"""
+		if not self.options.rate_limit:
+			return True
+		with self.lock:
+			tokens, date = self.buckets.get(client, (self.options.burst, time()))
+			tokens = min(self.options.burst, tokens + (time() - date)*self.options.rate_limit)
+			allowed = tokens >= 1
+			self.buckets[client] = (tokens - 1 if allowed else tokens, time())
+			return allowed
+
+	def new_assignment(self, owner, work_type):
+		line, (low, high) = work_types[work_type]
+		key = self.random_key()
+		with self.lock:
+			n = self.rng.randrange(low, high) | 1
+			self.assignments[key] = (owner, n)
+		return key, n, line.format(k=key, n=n)
+
+def query_args(query):
+	return dict((k, v[0]) for k, v in parse_qs(query, keep_blank_values=True).items())
+
+class PrimeNetHandler(BaseHTTPRequestHandler, object):
+	protocol_version = "HTTP/1.1" # keep-alive, as the server used by primenet.py
+	wbufsize = -1 # headers and body in one packet, else the delayed ACK adds 40 ms per request
+	cookie_name = "GIMPSWWW"
+
+	def do_GET(self):
+		self.dispatch(b"")
+
+	def do_POST(self):
+		self.dispatch(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+	def log_message(self, format, *args):
+		pass
+
+	def dispatch(self, data):
+		server = self.server
+		url = urlparse(self.path)
+		args = query_args(url.query)
+		args.update(query_args(data.decode("utf-8", "replace")))
+		if url.path.startswith("/v5server"):
+			endpoint = "v5:" + args.get("t", "")
+		elif url.path == "/stats":
+			return self.answer(200, json.dumps(server.counters.as_dict(), sort_keys=True), "application/json")
+		else:
+			endpoint = url.path.strip("/") or "default.php"
+		client = args.get("g") or self.session() or self.client_address[0]
+		delay = server.options.latency
+		if server.options.jitter:
+			with server.lock:
+				delay += server.rng.uniform(0, server.options.jitter)
+		if delay > 0:
+			sleep(delay)
+		if not server.allow(client):
+			return self.answer(429, "Too many requests", endpoint=endpoint)
+		for status, probability in server.options.http_errors:
+			if server.chance(probability):
+				return self.answer(status, "Injected error", endpoint=endpoint)
+		if endpoint.startswith("v5:"):
+			self.v5(endpoint, args)
+		elif endpoint == "default.php":
+			self.login(args)
+		elif endpoint == "manual_assignment":
+			self.manual_assignment(args)
+		elif endpoint == "manual_result/default.php":
+			self.manual_result(args)
+		else:
+			self.answer(404, "Not found", endpoint=endpoint)
+
+	def answer(self, status, body, content_type="text/html; charset=UTF-8", headers=(), endpoint=None, code=None):
+		body = body.encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		for header in headers:
+			self.send_header(*header)
+		self.end_headers()
+		self.wfile.write(body)
+		if endpoint is not None:
+			self.server.counters.add(endpoint, status if code is None else code,
+				len(self.path) + int(self.headers.get("Content-Length", 0)), len(body))
+
+	#######################################################################################################
+	# v5 API
+	#######################################################################################################
+
+	def v5_answer(self, endpoint, code, detail, **fields):
+		lines = ["pnErrorResult={0}".format(code), "pnErrorDetail=" + detail]
+		lines += ["{0}={1}".format(k, v) for k, v in fields.items()]
+		self.answer(200, "\n".join(lines + ["==END==", ""]), endpoint=endpoint, code=code)
+
+	def v5(self, endpoint, args):
+		server = self.server
+		for code, probability in server.options.errors:
+			if server.chance(probability):
+				return self.v5_answer(endpoint, code, "Injected error")
+		guid = args.get("g", "")
+		t = args.get("t")
+		if t == "uc":
+			with server.lock:
+				server.computers[guid] = args
+			return self.v5_answer(endpoint, primenet_api.ERROR_OK, "SUCCESS", g=guid, u=args.get("u", ""), cn=args.get("cn", ""))
+		if server.options.strict and guid not in server.computers:
+			return self.v5_answer(endpoint, primenet_api.ERROR_UNREGISTERED_CPU, "Unregistered computer")
+		if t == "po":
+			with server.lock:
+				server.computers.setdefault(guid, {})["w"] = args.get("w")
+			return self.v5_answer(endpoint, primenet_api.ERROR_OK, "SUCCESS")
+		if t == "ga":
+			work_type = int(server.computers.get(guid, {}).get("w", 0) or 101)
+			if work_type not in work_types:
+				work_type = 101
+			key, n, line = server.new_assignment(guid, work_type)
+			fields = dict(g=guid, k=key, w=work_type, n=n, sf=76, p1=1)
+			if work_type >= 150:
+				fields.update(A=1, b=2, c=-1, saved=0)
+			return self.v5_answer(endpoint, primenet_api.ERROR_OK, "Server assigned work.", **fields)
+		if t in ("ap", "ar"):
+			key = args.get("k", "")
+			if server.options.strict and key not in server.assignments:
+				return self.v5_answer(endpoint, primenet_api.ERROR_INVALID_ASSIGNMENT_KEY, "Invalid assignment key")
+			if t == "ar":
+				with server.lock:
+					server.assignments.pop(key, None)
+			return self.v5_answer(endpoint, primenet_api.ERROR_OK, "SUCCESS")
+		self.v5_answer(endpoint, primenet_api.ERROR_INVALID_TRANSACTION, "Invalid transaction")
+
+	#######################################################################################################
+	# www.mersenne.org pages
+	#######################################################################################################
+
+	def session(self):
+		for cookie in self.headers.get("Cookie", "").split(";"):
+			name, _, value = cookie.strip().partition("=")
+			if name == self.cookie_name:
+				with self.server.lock:
+					return self.server.sessions.get(value)
+		return None
+
+	def page(self, endpoint, user, content, headers=()):
+		"""Each page shows the user name when the session is valid"""
+		logged = "{0}<br>logged in".format(user) if user else "Login"
+		self.answer(200, "<html><body>{0}<br>\n{1}\n</body></html>".format(logged, content), headers=headers, endpoint=endpoint)
+
+	def login(self, args):
+		user = args.get("user_login")
+		if not user:
+			return self.page("default.php", self.session(), "")
+		cookie = self.server.random_key().lower()
+		with self.server.lock:
+			self.server.sessions[cookie] = user
+		self.page("default.php", user, "", headers=[("Set-Cookie", "{0}={1}; Max-Age=2592000; path=/".format(self.cookie_name, cookie))])
+
+	def manual_assignment(self, args):
+		user = self.session()
+		if user is None:
+			return self.page("manual_assignment", None, "Please log in")
+		work_type = int(args.get("pref", 101) or 101)
+		if work_type not in work_types:
+			return self.page("manual_assignment", user, "Error: unsupported work type")
+		lines = [self.server.new_assignment(user, work_type)[2] for i in range(int(args.get("num_to_get", 1) or 1))]
+		self.page("manual_assignment", user, "<pre>\n{0}\n</pre>".format("\n".join(lines)))
+
+	def manual_result(self, args):
+		user = self.session()
+		if user is None:
+			return self.page("manual_result/default.php", None, "Please log in")
+		self.page("manual_result/default.php", user, "Accepted" if args.get("data") else "<div>Error: no result</div>")
+
+def start_server(port=0, options=None):
+	"""Start the server in a thread, return it and its base URL"""
+	server = PrimeNetServer(("127.0.0.1", port), options)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server, "http://127.0.0.1:{0}/".format(server.server_address[1])
+
+def parse_errors(values, names=None):
+	"""Parse the CODE:PROBABILITY arguments, CODE being a number or the name of a primenet_api error"""
+	errors = []
+	for value in values:
+		code, _, probability = value.rpartition(":")
+		if names and hasattr(names, "ERROR_" + code.upper()):
+			code = getattr(names, "ERROR_" + code.upper())
+		errors.append((int(code), float(probability)))
+	return errors
+
+def main():
+	parser = OptionParser(usage="%prog [options]")
+	parser.add_option("--port", dest="port", type="int", default=8080, help="Port on 127.0.0.1, default %default")
+	parser.add_option("--latency", dest="latency", type="float", default=0, help="Seconds added to each answer, default %default")
+	parser.add_option("--jitter", dest="jitter", type="float", default=0, help="Random seconds added to the latency, default %default")
+	parser.add_option("--error", dest="errors", action="append", default=[], help="v5 error returned with a probability, like SERVER_BUSY:0.05 or 32:0.01, can be given several times")
+	parser.add_option("--http_error", dest="http_errors", action="append", default=[], help="HTTP status returned with a probability, like 503:0.01, can be given several times")
+	parser.add_option("--rate_limit", dest="rate_limit", type="float", default=0, help="Requests per second allowed by client (GUID, session or address), HTTP 429 beyond, default: no limit")
+	parser.add_option("--burst", dest="burst", type="int", default=10, help="Requests a client can send at once before being limited, default %default")
+	parser.add_option("--strict", action="store_true", dest="strict", default=False, help="Reject the unregistered GUIDs and the unknown assignment keys")
+	parser.add_option("--seed", dest="seed", type="int", default=0, help="Seed of the errors and assignments, default %default")
+	(options, args) = parser.parse_args()
+	server_options = ServerOptions(options.latency, options.jitter, parse_errors(options.errors, primenet_api),
+		parse_errors(options.http_errors), options.rate_limit, options.burst, options.strict, options.seed)
+	server, url = start_server(options.port, server_options)
+	print("Listening on {0}, use primenet.py --v5_url '{0}v5server/?' --www_url {0}".format(url))
+	try:
+		while True:
+			sleep(3600)
+	except KeyboardInterrupt:
+		pass
+	server.shutdown()
+	print(json.dumps(server.counters.as_dict(), indent=1, sort_keys=True))
+
+if __name__ == "__main__":
+	main()
+
+# vim: noexpandtab ts=4 sts=0 sw=0
@@ -6,9 +6,20 @@ usage () {
 }
 
 cleanup () {
-	for name in *.ref; do
-		rm -f "$(basename "$name" .ref)"
+	for name in $( find . -name "*.ref" ); do
+		rm -f "${name%.ref}"
 	done
+	# the expiry date of the saved cookies depends on the current time
+	rm -f primenet_cookies.txt
+	# the state is compared with its dump, primenet.db.sql
+	find . -name "primenet.db" -o -name "primenet.db-wal" -o -name "primenet.db-shm" | xargs rm -f
+	# the requests sent in flight are numbered in the order they are sent, which can vary,
+	# so they may have no reference
+	for name in $( find . -name "response_*.log" ); do
+		rm -f "${name/response_/request_}"
+	done
+	# the run lock of each workdir
+	find . -name "primenet.lock" | xargs rm -f
 }
 
 DIR=$1
@@ -22,8 +33,8 @@ cd $DIR
 
 cleanup
 # copy inputs
-for name in $( ls *.in 2>/dev/null ); do
-	cp "$name" "$(basename "$name" .in)"
+for name in $( find . -name "*.in" ); do
+	cp "$name" "${name%.in}"
 done
 
 # run the command with the args
@@ -31,10 +42,10 @@ ${PYTHON} ${SRC_DIR}/primenet.py $(cat args) -t 0 -ddd |& tee stdout.log >/dev/n
 
 # check outputs
 EXIT=0
-for name in *.ref; do
-	diff -q "$name" "$(basename "$name" .ref)" >/dev/null
+for name in $( find . -name "*.ref" | sort ); do
+	diff -q "$name" "${name%.ref}" >/dev/null
 	EXITCODE=$?
-	[ $EXITCODE -eq 0 ] || echo diff "$name" "$(basename "$name" .ref)"
+	[ $EXITCODE -eq 0 ] || echo diff "$name" "${name%.ref}"
 	EXIT=$(( $EXIT || $EXITCODE ))
 done
 
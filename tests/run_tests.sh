@@ -36,5 +36,12 @@ for testname in $( ls -d test_* ); do
 	EXIT=$(( $EXIT || $EXITCODE ))
 done
 
+# what the tests above can't run, as they run primenet.py with -t 0
+if ! OUTPUT=$( $python unit_tests.py 2>&1 ); then
+	echo "$OUTPUT"
+	echo "Unit tests FAILED" 1>&2
+	EXIT=1
+fi
+
 exit $EXIT
 # vim: noexpandtab ts=4 sts=0 sw=0
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Unit tests of what the golden tests (test_*/) can't run, as they run primenet.py with -t 0:
+# the file watcher of --watch, the handling of its changes and the planning of the updates in daemon mode,
+# the outputs which change with each run, like the dump of --profile or the spans of --trace,
+# and what another process sees: the run lock of the workdirs and the replacement of the files.
+# usage: unit_tests.py [-v]
+
+from __future__ import division, print_function
+import json
+import os
+import re
+import sys
+import shutil
+import subprocess
+import tempfile
+import unittest
+from threading import Timer
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import primenet
+
+primenet.options, _ = primenet.parser.parse_args([])
+
+def append_line(filename, line, delay):
+	"""Append a line to filename after delay seconds, as Mlucas does"""
+	timer = Timer(delay, primenet.write_list_file, (filename, [line], "a"))
+	timer.start()
+	return timer
+
+class PollingFileWatcher(primenet.FileWatcher):
+	"""The watcher used where inotify is not available"""
+	def init_inotify(self):
+		raise OSError("disabled by the test")
+
+class FileWatcherTest(unittest.TestCase):
+	watcher_class = PollingFileWatcher
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.dirs = [os.path.join(self.tmpdir, name) for name in ("run0", "run1")]
+		for dirname in self.dirs:
+			os.mkdir(dirname)
+			primenet.write_list_file(os.path.join(dirname, "worktodo.ini"), ["DoubleCheck=5FFFA71F8C4551B8A519C1E68E8F62F1,56601163,74,1"])
+		self.timers = []
+		self.watcher = self.watcher_class(self.dirs, poll_interval=0.05, settle_delay=0.3)
+
+	def tearDown(self):
+		for timer in self.timers:
+			timer.cancel()
+		if self.watcher.fd is not None:
+			os.close(self.watcher.fd)
+		shutil.rmtree(self.tmpdir)
+
+	def test_result_appended(self):
+		self.timers.append(append_line(os.path.join(self.dirs[0], "results.txt"), "M56601163 is not prime.", 0.1))
+		start = time()
+		self.assertEqual(self.watcher.wait(10), set([self.dirs[0]]))
+		self.assertTrue(time() - start < 5)
+
+	def test_timeout(self):
+		start = time()
+		self.assertEqual(self.watcher.wait(0.2), set())
+		self.assertTrue(time() - start >= 0.2)
+
+	def test_other_files_ignored(self):
+		self.timers.append(append_line(os.path.join(self.dirs[0], "p56601163.stat"), "Iter# = 10000", 0.05))
+		self.assertEqual(self.watcher.wait(0.3), set())
+
+	def test_worktodo_replaced(self):
+		# as Mlucas or replace_file() do
+		self.timers.append(Timer(0.1, primenet.write_list_file, (os.path.join(self.dirs[1], "worktodo.ini"), [])))
+		self.timers[-1].start()
+		self.assertEqual(self.watcher.wait(10), set([self.dirs[1]]))
+
+	def test_settle_delay(self):
+		# the writes made during the settle delay are reported with the first one
+		self.timers.append(append_line(os.path.join(self.dirs[0], "results.txt"), "M56601163 is not prime.", 0.1))
+		self.timers.append(append_line(os.path.join(self.dirs[1], "results.txt"), "M56601163 is not prime.", 0.25))
+		self.assertEqual(self.watcher.wait(10), set(self.dirs))
+		self.assertEqual(self.watcher.wait(0.2), set())
+
+class InotifyFileWatcherTest(FileWatcherTest):
+	watcher_class = primenet.FileWatcher
+
+	def run(self, result=None):
+		# inotify is only available on Linux
+		watcher = primenet.FileWatcher([tempfile.gettempdir()])
+		if watcher.fd is None:
+			return
+		os.close(watcher.fd)
+		return FileWatcherTest.run(self, result)
+
+class FakeWatcher(object):
+	"""Report the changes of the given directories, then nothing until the timeout"""
+	def __init__(self, changes):
+		self.changes = list(changes)
+
+	def wait(self, timeout):
+		if self.changes:
+			return self.changes.pop(0)
+		sleep(timeout)
+		return set()
+
+class WatchWorkdirsTest(unittest.TestCase):
+	def setUp(self):
+		self.calls = []
+		self.saved = primenet.submit_work, primenet.get_assignment
+		primenet.submit_work = lambda: self.calls.append(("submit", primenet.workdir))
+		primenet.get_assignment = lambda progress: self.calls.append(("fetch", primenet.workdir, progress))
+		self.workdirs = [primenet.Workdir(name, primenet.options) for name in ("run0", "run1")]
+
+	def tearDown(self):
+		primenet.submit_work, primenet.get_assignment = self.saved
+
+	def test_changed_workdir_only(self):
+		primenet.watch_workdirs(FakeWatcher([set(["run1"])]), self.workdirs, 0.2)
+		# the progress is not sent, only the periodic updates send it
+		self.assertEqual(self.calls, [("submit", "run1"), ("fetch", "run1", None)])
+
+	def test_until_timeout(self):
+		start = time()
+		primenet.watch_workdirs(FakeWatcher([set(["run0"]), set(["run0", "run1"])]), self.workdirs, 0.2)
+		self.assertTrue(time() - start >= 0.2)
+		self.assertEqual([call[1] for call in self.calls if call[0] == "submit"], ["run0", "run0", "run1"])
+
+class GoldenInputsTest(unittest.TestCase):
+	"""Run primenet.py on a copy of the inputs of a golden test"""
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def copy_inputs(self, test_dir):
+		test_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), test_dir)
+		for name in os.listdir(test_dir):
+			if name.endswith(".in"):
+				shutil.copy(os.path.join(test_dir, name), os.path.join(self.tmpdir, name[:-len(".in")]))
+			elif name.endswith(".stat") or re.match(r"response_\d+\.log$", name):
+				shutil.copy(os.path.join(test_dir, name), self.tmpdir)
+
+	def start(self, *args):
+		return subprocess.Popen([sys.executable, primenet.__file__.replace(".pyc", ".py")] + list(args) + ["-ddd"],
+			cwd=self.tmpdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+	def run_primenet(self, test_dir, *args):
+		"""Run a single update, as the golden tests, and return its output"""
+		self.copy_inputs(test_dir)
+		return self.run_again(*args)
+
+	def run_again(self, *args):
+		"""Run a single update on the outputs of the previous run"""
+		process = self.start(*(list(args) + ["-t", "0"]))
+		output = process.communicate()[0]
+		self.assertEqual(process.returncode, 0, output)
+		return output
+
+	def path(self, name):
+		return os.path.join(self.tmpdir, name)
+
+class NextUpdateTest(GoldenInputsTest):
+	"""Run primenet.py in daemon mode until it plans the next update"""
+	def next_update(self, test_dir, timeout):
+		self.copy_inputs(test_dir)
+		process = self.start("-t", str(timeout))
+		# the daemon sleeps until the next update once it is planned
+		timer = Timer(60, process.kill)
+		timer.start()
+		try:
+			for line in iter(process.stdout.readline, ""):
+				if "Next update in" in line:
+					return line.split(": ")[-1].strip()
+			self.fail("no update planned")
+		finally:
+			timer.cancel()
+			if process.poll() is None:
+				process.kill()
+			process.wait()
+			process.stdout.close()
+
+	def request(self, n):
+		with open(self.path("request_{0}.log".format(n))) as request:
+			return request.readline()
+
+	def test_days_left(self):
+		# 42.0 days left, the wait is not limited to --timeout
+		self.assertEqual(self.next_update("test_update_stat_2_lines", 6*3600), "Next update in 168.0 hours")
+		self.assertTrue("&d=604800&" in self.request(0))
+
+	def test_end_near(self):
+		# 3.7 days left
+		self.assertEqual(self.next_update("test_update_stat_percent_limit", 6*3600), "Next update in 43.8 hours")
+		self.assertTrue("&d=157809&e=315619&" in self.request(0))
+
+	def test_unknown_end(self):
+		self.assertEqual(self.next_update("test_error_http_405", 6*3600), "Next update in 6.0 hours")
+		self.assertTrue("&d=21600&" in self.request(0))
+
+class ProfileTest(GoldenInputsTest):
+	def write(self, name, data):
+		with open(self.path(name), "w") as File:
+			File.write(data)
+
+	def read(self, name):
+		with open(self.path(name)) as File:
+			return File.read()
+
+	def test_profile_rotated(self):
+		self.write("profile", "cycle 2")
+		self.write("profile.1", "cycle 1")
+		self.write("profile.2", "cycle 0")
+		self.run_primenet("test_update_stat_2_lines", "--profile", "profile", "--profile_keep", "3")
+		import pstats
+		functions = set(function for (filename, line, function) in pstats.Stats(self.path("profile")).stats)
+		self.assertTrue("update_workdirs" in functions)
+		self.assertEqual(self.read("profile.1"), "cycle 2")
+		self.assertEqual(self.read("profile.2"), "cycle 1")
+		self.assertFalse(os.path.exists(self.path("profile.3")))
+
+class TraceTest(GoldenInputsTest):
+	# the progress of the two assignments is sent by two threads
+	args = ("-n", "3", "--max_in_flight", "2", "--trace", "trace.json")
+
+	def test_chrome(self):
+		self.run_primenet("test_one_assignment", *self.args)
+		with open(self.path("trace.json")) as File:
+			data = File.read()
+		# the closing ] is optional
+		self.assertTrue(data.startswith("[\n") and data.endswith("},\n"))
+		events = json.loads(data.rstrip(",\n") + "]")
+		self.assertEqual(events[0]["name"], "cycle")
+		for event in events:
+			self.assertEqual(event["ph"], "X")
+			self.assertTrue(event["ts"] >= events[0]["ts"] and event["ts"] + event["dur"] <= events[0]["ts"] + events[0]["dur"] + 1)
+		self.assertEqual(len(set(event["tid"] for event in events if event["name"] == "send_progress")), 2)
+
+	def test_otlp(self):
+		self.run_primenet("test_one_assignment", "--trace_format", "otlp", *self.args)
+		with open(self.path("trace.json")) as File:
+			requests = [json.loads(line) for line in File]
+		self.assertEqual(len(requests), 1)
+		spans = requests[0]["resourceSpans"][0]["scopeSpans"][0]["spans"]
+		names = dict((span["spanId"], span["name"]) for span in spans)
+		self.assertEqual(len(names), len(spans))
+		self.assertEqual(set(span["traceId"] for span in spans), set([spans[0]["traceId"]]))
+		# a single root, the spans of the threads sending the progress are not orphans
+		self.assertEqual([span["name"] for span in spans if "parentSpanId" not in span], ["cycle"])
+		parents = [(span["name"], names[span["parentSpanId"]]) for span in spans if "parentSpanId" in span]
+		self.assertEqual(parents.count(("send_progress", "progress")), 2)
+		self.assertEqual(parents.count(("v5 ap", "send_progress")), 2)
+
+class LockWorkdirTest(GoldenInputsTest):
+	def test_workdir_skipped(self):
+		# the lock held by the previous run, still running
+		with open(self.path("primenet.lock"), "a") as lock:
+			if not primenet.lock_file(lock, blocking=False):
+				self.fail("primenet.lock is held")
+			output = self.run_primenet("test_update_stat_2_lines")
+		self.assertTrue(". is used by an other primenet.py process, skipping it" in output, output)
+		self.assertFalse(os.path.exists(self.path("request_0.log")))
+		self.assertFalse(os.path.exists(self.path("primenet.db")))
+
+	def test_lock_released(self):
+		self.run_primenet("test_update_stat_2_lines")
+		with open(self.path("primenet.lock"), "a") as lock:
+			self.assertTrue(primenet.lock_file(lock, blocking=False))
+
+class ReplaceFileTest(GoldenInputsTest):
+	def read(self, name):
+		with open(self.path(name)) as File:
+			return File.read()
+
+	def test_worktodo_appended(self):
+		self.copy_inputs("test_one_assignment")
+		old = self.read("worktodo.ini")
+		inode = os.stat(self.path("worktodo.ini")).st_ino
+		# Mlucas reading worktodo.ini while primenet.py adds the assignments
+		with open(self.path("worktodo.ini")) as reader:
+			self.assertEqual(reader.read(), old)
+			self.run_primenet("test_one_assignment", "-n", "3")
+			# the assignments are appended whole to the same file
+			added = reader.read()
+		self.assertEqual(os.stat(self.path("worktodo.ini")).st_ino, inode)
+		self.assertEqual(self.read("worktodo.ini"), old + added)
+		self.assertEqual([line.split(",")[1] for line in added.splitlines()], ["55172981"])
+
+	def test_local_ini_replaced(self):
+		self.copy_inputs("test_one_assignment")
+		old = self.read("local.ini")
+		with open(self.path("local.ini")) as reader:
+			self.run_primenet("test_one_assignment", "-n", "3")
+			# the old file is complete, the new one replaced it
+			self.assertEqual(reader.read(), old)
+		self.assertNotEqual(self.read("local.ini"), old)
+		self.assertEqual([name for name in os.listdir(self.tmpdir) if name.endswith(".tmp")], [])
+
+	def test_content_and_mode(self):
+		filename = self.path("local.ini")
+		primenet.write_list_file(filename, ["[primenet]", "password = secret"])
+		os.chmod(filename, 0o600)
+		with primenet.replace_file(filename) as File:
+			File.write("[primenet]\n")
+			File.flush()
+			# the old content until the end of the block
+			self.assertEqual(self.read("local.ini"), "[primenet]\npassword = secret\n")
+		self.assertEqual(self.read("local.ini"), "[primenet]\n")
+		self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+
+	def test_error(self):
+		filename = self.path("worktodo.ini")
+		primenet.write_list_file(filename, ["DoubleCheck=5FFFA71F8C4551B8A519C1E68E8F62F1,56601163,74,1"])
+		try:
+			with primenet.replace_file(filename) as File:
+				File.write("partial")
+				raise IOError("disk full")
+		except IOError:
+			pass
+		self.assertEqual(self.read("worktodo.ini"), "DoubleCheck=5FFFA71F8C4551B8A519C1E68E8F62F1,56601163,74,1\n")
+		self.assertEqual(os.listdir(self.tmpdir), ["worktodo.ini"])
+
+class StatScanTest(GoldenInputsTest):
+	"""The scan of the p*.stat files is saved in primenet.db, and continued by the next run"""
+	statfile = "p56601163.stat"
+	line = "[2020-04-04 10:52:14] M56601163 Iter# = 30000 [ 0.05% complete] clocks = 00:11:27.234 [ 68.7234 msec/iter] Res64: 5E2C1FB4A8E2A03D. AvgMaxErr = 0.168750000. MaxErr = 0.218750000. Residue shift count = 21040539.\n"
+
+	def scanned_bytes(self):
+		"""Bytes read by parse_stat_file in the last run, from its trace"""
+		with open(self.path("trace.json")) as File:
+			events = json.loads(File.read().rstrip(",\n") + "]")
+		os.remove(self.path("trace.json"))
+		return [event["args"]["bytes"] for event in events if event["name"] == "parse_stat_file"]
+
+	def test_appended(self):
+		output = self.run_primenet("test_update_stat_2_lines", "--trace", "trace.json")
+		size = os.path.getsize(self.path(self.statfile))
+		self.assertEqual(self.scanned_bytes(), [size])
+		self.assertTrue("p:56601163 is 0.04% done" in output, output)
+		self.run_again("--trace", "trace.json")
+		self.assertEqual(self.scanned_bytes(), [0])
+		with open(self.path(self.statfile), "a") as File:
+			File.write(self.line)
+		output = self.run_again("--trace", "trace.json")
+		self.assertEqual(self.scanned_bytes(), [len(self.line)])
+		self.assertTrue("p:56601163 is 0.05% done" in output, output)
+
+	def test_restarted(self):
+		self.run_primenet("test_update_stat_2_lines", "--trace", "trace.json")
+		self.scanned_bytes()
+		# Mlucas restarted with a larger FFT, then wrote more than the 5 Iter# lines used
+		lines = "M56601163: using FFT length 3328K = 3407872 8-byte floats, initial residue shift count = 21040539\n"
+		lines += "".join(self.line.replace("30000", str(iteration)) for iteration in range(30000, 100000, 10000))
+		with open(self.path(self.statfile), "a") as File:
+			File.write(lines)
+		self.run_again("--trace", "trace.json")
+		self.assertEqual(self.scanned_bytes(), [len(lines)])
+		with open(self.path("primenet.db.sql")) as File:
+			self.assertTrue("VALUES('fft_speed','3328'," in File.read())
+
+	def test_replaced(self):
+		self.run_primenet("test_update_stat_2_lines", "--trace", "trace.json")
+		self.scanned_bytes()
+		# Mlucas started the test again
+		with open(self.path(self.statfile), "w") as File:
+			File.write(self.line)
+		output = self.run_again("--trace", "trace.json")
+		self.assertEqual(self.scanned_bytes(), [len(self.line)])
+		self.assertTrue("p:56601163 is 0.05% done" in output, output)
+
+class WindowsRenameTest(GoldenInputsTest):
+	"""os.rename of Windows, which fails when the target exists, and no os.replace as before Python 3.3"""
+	def setUp(self):
+		GoldenInputsTest.setUp(self)
+		self.saved = os.name, os.rename, getattr(os, "replace", None)
+		rename = os.rename
+		def windows_rename(src, dst):
+			if os.path.exists(dst):
+				raise OSError(17, "Cannot create a file when that file already exists", dst)
+			rename(src, dst)
+		os.name, os.rename = "nt", windows_rename
+		if self.saved[2] is not None:
+			del os.replace
+
+	def tearDown(self):
+		os.name, os.rename, replace = self.saved
+		if replace is not None:
+			os.replace = replace
+		GoldenInputsTest.tearDown(self)
+
+	def test_replace_existing(self):
+		filename = self.path("worktodo.ini")
+		primenet.write_list_file(filename, ["DoubleCheck=5FFFA71F8C4551B8A519C1E68E8F62F1,56601163,74,1"])
+		primenet.write_list_file(filename, [])
+		with open(filename) as File:
+			self.assertEqual(File.read(), "\n")
+		self.assertEqual(os.listdir(self.tmpdir), ["worktodo.ini"])
+
+	def test_profile_rotated(self):
+		for n, name in enumerate(("profile", "profile.1", "profile.2")):
+			with open(self.path(name), "w") as File:
+				File.write("cycle {0}".format(2 - n))
+		profiler = primenet.Profiler(self.path("profile"), 3)
+		profiler.start()
+		profiler.stop()
+		with open(self.path("profile.2")) as File:
+			self.assertEqual(File.read(), "cycle 1")
+		self.assertEqual(sorted(os.listdir(self.tmpdir)), ["profile", "profile.1", "profile.2"])
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: noexpandtab ts=4 sts=0 sw=0
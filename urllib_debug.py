@@ -12,6 +12,7 @@ except ImportError:
 	from urllib2 import addinfourl
 
 from io import BytesIO
+from threading import Lock
 
 def save_request(req, output):
 	print("{0} {1}".format(req.get_method(), req.get_full_url()), file=output)
@@ -28,14 +29,21 @@ def save_request(req, output):
 # Spy Handlers for HTTP and HTTPS request
 # They store the request in request_%d.log in current directory and responses in response_%d.log
 _req_count = 0
+# the requests may be sent by several threads (--max_in_flight)
+_req_lock = Lock()
+def next_request_number():
+	global _req_count
+	with _req_lock:
+		_req_count += 1
+		return _req_count - 1
+
 def spy_http_open(req, super_method):
 	# super_method arg is http_open or https_open to be called
-	global _req_count
-	request_filename = "request_{0}.log".format(_req_count)
-	response_filename = "response_{0}.log".format(_req_count)
+	n = next_request_number()
+	request_filename = "request_{0}.log".format(n)
+	response_filename = "response_{0}.log".format(n)
 	try:
 		with open(request_filename, "wt") as output:
-			_req_count += 1
 			save_request(req, output)
 		# TODO: intercept exceptions that can be raise by http_open() and r.read() to log them ?
 		r = super_method(req)
@@ -82,13 +90,12 @@ else:
 
 def test_http_open(req, super_method):
 	# super_method arg is http_open or https_open to be called
-	global _req_count
-	request_filename = "request_{0}.log".format(_req_count)
-	response_filename = "response_{0}.log".format(_req_count)
+	n = next_request_number()
+	request_filename = "request_{0}.log".format(n)
+	response_filename = "response_{0}.log".format(n)
 	try:
 		# save the request
 		with open(request_filename, "wt") as output:
-			_req_count += 1
 			save_request(req, output)
 	except (IOError,OSError):
 		pass